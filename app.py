@@ -1,28 +1,83 @@
-from flask import Flask, render_template, redirect, request, session, url_for, jsonify, Response
+from flask import Flask, render_template, redirect, request, session, url_for, jsonify, Response, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
+from werkzeug.security import generate_password_hash, check_password_hash
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 import os
-import uuid
+import secrets
+import hmac
+import hashlib
+import re
 import time
 import csv
 import io
+import json
+import functools
+import queue
+import threading
+import atexit
+import sys
+import logging
+import logging.handlers
+import orjson
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, with Flask's own conversions for other types"""
+    def dumps(self, obj, **kwargs):
+        # Datetimes are passed through so they keep Flask's HTTP-date format
+        return orjson.dumps(
+            obj,
+            default=self.default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # jsonify() and request.get_json() on every ESP32 post
 CORS(app)  # Enable CORS for ESP32 communication
 
+# Gzip dashboard pages and JSON responses (usage summaries run to hundreds of KB).
+# Streamed responses are left alone: compressing them would buffer the whole body,
+# which breaks the /stream event feed and the row-by-row CSV downloads, so CSV is
+# deliberately not listed.
+app.config['COMPRESS_MIMETYPES'] = ['application/json', 'text/html']
+app.config['COMPRESS_LEVEL'] = 5
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+
 # Secret configuration
 SECRET_TOKEN = os.environ.get("SECRET_TOKEN", "12345678")
 app.secret_key = os.environ.get("SECRET_KEY", "supersecretkey")
 
+# ------------------------------- 
+# 📝 Logging
+# ------------------------------- 
+# Handlers only enqueue records; a background listener thread does the actual
+# stdout writes, so request threads never block on console I/O.
+# Set LOG_LEVEL=WARNING in production to drop the per-write info messages.
+log_queue = queue.Queue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+logger = logging.getLogger("aquasolar")
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+log_listener.start()
+atexit.register(log_listener.stop)
+
 # ------------------------------- 
 # 🔥 Firebase Initialization
 # ------------------------------- 
 try:
     # For Render deployment, use environment variable for credentials
     if os.environ.get("FIREBASE_CREDENTIALS"):
-        import json
         cred_dict = json.loads(os.environ.get("FIREBASE_CREDENTIALS"))
         cred = credentials.Certificate(cred_dict)
     else:
@@ -30,38 +85,320 @@ try:
         cred = credentials.Certificate('aqua-7ced9-firebase-adminsdk-fbsvc-d94e9eb953.json')
     
     firebase_admin.initialize_app(cred)
+    # The one Firestore client for this process: every collection and subcollection
+    # ref is built from it, so all requests multiplex over the same gRPC channel
     db = firestore.client()
-    print("✅ Firebase initialized successfully")
+    logger.info("✅ Firebase initialized successfully")
 except Exception as e:
-    print(f"❌ Firebase initialization error: {e}")
+    logger.error(f"❌ Firebase initialization error: {e}")
     db = None
 
+def warm_firestore_channel():
+    """Issue one cheap read so the gRPC channel is open before the first request"""
+    if db is None:
+        return
+    try:
+        db.collection('accounts').limit(1).get()
+        logger.info("✅ Firestore channel warmed")
+    except Exception as e:
+        logger.warning(f"⚠️ Firestore warmup failed: {e}")
+
+warm_firestore_channel()
+
 # ------------------------------- 
 # 📊 Cache and Throttling Configuration
 # ------------------------------- 
-# Cache to prevent duplicate/excessive writes (per account)
-account_cache = {}
+# Cache to prevent duplicate/excessive writes (per account), least recently used first
+account_cache = OrderedDict()
+account_cache_lock = threading.Lock()
+ACCOUNT_CACHE_MAX_ENTRIES = 10000
+ACCOUNT_CACHE_TTL = 86400            # forget accounts that haven't posted for a day
+ACCOUNT_CACHE_PRUNE_INTERVAL = 3600  # how often to look for idle accounts
+last_account_cache_prune = 0
+
+# Account IDs a device posted that turned out not to exist: account_id -> (cached_at, True)
+# Bad or spoofed IDs get their 404 from memory instead of a Firestore read every post
+unknown_account_cache = {}
+UNKNOWN_ACCOUNT_TTL = 60.0       # seconds, so an account created meanwhile is found soon
+
+# Generated IDs look like ACC_1A2B3C4D; anything else (slashes, non-strings) can't be a document ID
+ACCOUNT_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,128}')
+
+def is_valid_account_id(account_id):
+    """Check an account ID is a string that can safely name a Firestore document"""
+    return isinstance(account_id, str) and ACCOUNT_ID_PATTERN.fullmatch(account_id) is not None
 
 def get_account_cache(account_id):
-    """Get or create cache for a specific account"""
-    if account_id not in account_cache:
-        account_cache[account_id] = {
+    """Get or create cache for a specific account, or None if the account doesn't exist"""
+    global last_account_cache_prune
+    now = time.time()
+    with account_cache_lock:
+        # Periodically evict idle accounts so memory stays bounded
+        if now - last_account_cache_prune >= ACCOUNT_CACHE_PRUNE_INTERVAL:
+            for idle_id in [k for k, v in account_cache.items() if now - v['last_seen'] >= ACCOUNT_CACHE_TTL]:
+                del account_cache[idle_id]
+            last_account_cache_prune = now
+        
+        if account_id in account_cache:
+            account_cache.move_to_end(account_id)
+            account_cache[account_id]['last_seen'] = now
+            return account_cache[account_id]
+    
+    cached = unknown_account_cache.get(account_id)
+    if cached and time.monotonic() - cached[0] < UNKNOWN_ACCOUNT_TTL:
+        return None
+    
+    # First post from this account since startup: only cache accounts that really exist
+    if not db.collection('accounts').document(account_id).get().exists:
+        cache_put(unknown_account_cache, account_id, True)
+        return None
+    
+    with account_cache_lock:
+        cache = account_cache.setdefault(account_id, {
             'last_sensor_log_time': 0,
             'last_power_log_time': 0,
             'last_consumption_update_time': 0,
-            'last_logged_values': {}
-        }
-    return account_cache[account_id]
+            'last_logged_values': {},
+            'last_alert_times': {},
+            'last_status_hash': None,
+            'last_status_write_time': 0,
+            'lock': threading.Lock()
+        })
+        cache['last_seen'] = now
+        account_cache.move_to_end(account_id)
+        while len(account_cache) > ACCOUNT_CACHE_MAX_ENTRIES:
+            account_cache.popitem(last=False)
+        return cache
 
 # Thresholds for significant changes (only log when exceeded)
 FLOW_CHANGE_THRESHOLD = 0.5      # L/min
 BATTERY_CHANGE_THRESHOLD = 5     # percent
 VOLTAGE_CHANGE_THRESHOLD = 0.3   # volts
 
+# Alert conditions as bit flags
+LEAKAGE_BIT = 1
+LOW_BATTERY_BIT = 2
+LOW_BATTERY_PERCENT = 10
+
+# While a condition holds, repeat its alert at most this often (seconds)
+ALERT_COOLDOWNS = {
+    LEAKAGE_BIT: 300,
+    LOW_BATTERY_BIT: 600
+}
+
+# Per-account state a status post advances; saved first so a failed post can be undone
+THROTTLE_STATE_KEYS = (
+    'last_sensor_log_time', 'last_power_log_time', 'last_consumption_update_time',
+    'last_logged_values', 'last_alert_times', 'last_status_hash', 'last_status_write_time'
+)
+
+def snapshot_throttle_state(cache):
+    """Copy an account's throttle state (call with cache['lock'] held)"""
+    return {key: dict(cache[key]) if isinstance(cache[key], dict) else cache[key] for key in THROTTLE_STATE_KEYS}
+
+def is_alert_due(cache, alert_bit, current_time):
+    """Allow an alert once its cooldown has passed for this account, starting a new one"""
+    last_alert_times = cache['last_alert_times']
+    if current_time - last_alert_times.get(alert_bit, 0) < ALERT_COOLDOWNS[alert_bit]:
+        return False
+    last_alert_times[alert_bit] = current_time
+    return True
+
 # Logging intervals (in seconds)
 SENSOR_LOG_INTERVAL = 300        # Log sensor data every 5 minutes
 POWER_LOG_INTERVAL = 600         # Log power data every 10 minutes
 CONSUMPTION_UPDATE_INTERVAL = 1800  # Update consumption every 30 minutes
+STATUS_REWRITE_INTERVAL = 30     # Rewrite an unchanged realtime status at most every 30 seconds
+SUMMARY_WINDOW_DAYS = 30         # Days covered by the "month" consumption summary
+
+# Dashboard read cache: account_id -> (cached_at, summary)
+consumption_cache = {}
+CONSUMPTION_CACHE_TTL = 60.0     # seconds, entries are dropped once a consumption write lands
+
+# Realtime status read cache: account_id -> (cached_at, status)
+status_cache = {}
+STATUS_CACHE_TTL = 2.0           # seconds
+
+# Command document read cache: account_id -> (cached_at, command)
+# Pending commands are never served from it, so a delivery is never repeated
+command_cache = {}
+COMMAND_CACHE_TTL = 2.0          # seconds
+
+# Login lookup cache: normalized email -> (cached_at, user); only found users are cached
+user_cache = {}
+USER_CACHE_TTL = 60.0            # seconds, entries are dropped whenever the user is updated
+
+# Usage range cache: (account_id, start, end, version) -> (cached_at, usage data)
+# Log and consumption writes bump the account's version both when they are staged and
+# when they land, so a range read in between is never served once the write is visible
+usage_cache = {}
+usage_versions = {}
+USAGE_CACHE_TTL = 300.0          # seconds
+
+READ_CACHE_MAX_ENTRIES = 1024
+read_cache_lock = threading.Lock()
+
+def cache_put(cache, key, value):
+    """Store a (cached_at, value) entry, evicting the oldest one when the cache is full"""
+    with read_cache_lock:
+        if key not in cache and len(cache) >= READ_CACHE_MAX_ENTRIES:
+            del cache[min(cache, key=lambda k: cache[k][0])]
+        cache[key] = (time.monotonic(), value)
+
+# ------------------------------- 
+# ⚙️ Background Write Queue
+# ------------------------------- 
+# ESP32 writes are committed by worker threads so requests never wait on Firestore.
+# Each account always goes to the same worker, so its updates commit in order, and
+# whatever one account has queued meanwhile is combined into shared commits
+WRITE_QUEUE_SIZE = 10000
+WRITE_WORKERS = 4
+WRITE_DRAIN_LIMIT = 400        # queued updates a worker picks up at once
+MAX_WRITES_PER_COMMIT = 400    # Firestore caps a single commit at 500 writes
+write_queues = [queue.Queue(maxsize=WRITE_QUEUE_SIZE // WRITE_WORKERS) for _ in range(WRITE_WORKERS)]
+
+# Updates rejected because the queue was full (e.g. during a Firestore outage)
+dropped_writes = 0
+dropped_writes_lock = threading.Lock()
+
+WRITE_RETRIES = 3              # attempts per Firestore write
+WRITE_RETRY_BASE_DELAY = 0.2   # seconds, doubled after each failed attempt
+
+def retry_with_backoff(func):
+    """Retry a Firestore call with exponential backoff before giving up"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == WRITE_RETRIES - 1:
+                    raise
+                delay = WRITE_RETRY_BASE_DELAY * (2 ** attempt)
+                logger.warning(f"⚠️ {func.__name__} failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
+    return wrapper
+
+class PendingWrites:
+    """Records set/update calls like a WriteBatch so queued updates can share commits"""
+    
+    def __init__(self):
+        self.ops = []
+    
+    def set(self, doc_ref, data, merge=False):
+        self.ops.append(('set', doc_ref, data, merge))
+    
+    def update(self, doc_ref, data):
+        self.ops.append(('update', doc_ref, data, None))
+
+def enqueue_batch(batch, account_id=None):
+    """Queue recorded writes for background commit; False if the queue is full"""
+    global dropped_writes
+    try:
+        write_queues[hash(account_id) % WRITE_WORKERS].put_nowait((batch, account_id))
+        return True
+    except queue.Full:
+        with dropped_writes_lock:
+            dropped_writes += 1
+        logger.warning(f"⚠️ Write queue full, dropped update for {account_id}")
+        return False
+
+def commit_account_updates(account_id, updates):
+    """Replay one account's queued updates, in order, into as few WriteBatch commits as possible"""
+    batch, paths = db.batch(), set()
+    
+    for writes in updates:
+        doc_paths = {doc_ref.path for _, doc_ref, _, _ in writes.ops}
+        # Keep each update in one commit, and never write a document twice per commit
+        if len(paths) + len(writes.ops) > MAX_WRITES_PER_COMMIT or paths & doc_paths:
+            commit_account_batch(batch, account_id, paths)
+            batch, paths = db.batch(), set()
+        
+        for op, doc_ref, data, merge in writes.ops:
+            if op == 'update':
+                batch.update(doc_ref, data)
+            else:
+                batch.set(doc_ref, data, merge=merge)
+        paths |= doc_paths
+    
+    if paths:
+        commit_account_batch(batch, account_id, paths)
+
+def commit_account_batch(batch, account_id, paths):
+    """Commit one account's writes, then retire cached reads taken before they landed"""
+    if commit_batch(batch, account_id):
+        bump_usage_version(account_id)
+        # Consumption moved: the next dashboard read fetches the new totals
+        if get_daily_totals_ref(account_id).path in paths:
+            consumption_cache.pop(account_id, None)
+
+def commit_pending(pending):
+    """Commit queued updates account by account, so one bad write only costs its own account"""
+    by_account = {}
+    for writes, account_id in pending:
+        by_account.setdefault(account_id, []).append(writes)
+    
+    for account_id, updates in by_account.items():
+        try:
+            commit_account_updates(account_id, updates)
+        except Exception as e:
+            logger.error(f"Error committing queued writes for {account_id}: {e}")
+
+def _write_worker(write_queue):
+    """Commit one queue's updates, combining whatever is waiting into shared batches"""
+    while True:
+        pending = [write_queue.get()]
+        try:
+            while len(pending) < WRITE_DRAIN_LIMIT:
+                pending.append(write_queue.get_nowait())
+        except queue.Empty:
+            pass
+        
+        try:
+            commit_pending(pending)
+        except Exception as e:
+            logger.error(f"Error committing queued writes: {e}")
+        finally:
+            for _ in pending:
+                write_queue.task_done()
+
+for worker_queue in write_queues:
+    threading.Thread(target=_write_worker, args=(worker_queue,), daemon=True).start()
+
+# Let pending writes land before the process exits
+for worker_queue in write_queues:
+    atexit.register(worker_queue.join)
+
+# Standalone log entries (outside a status batch) go through a BulkWriter, which
+# sends them in parallel batches from its own threads instead of one RPC each
+BULK_FLUSH_INTERVAL = 2   # seconds
+bulk_writer = db.bulk_writer() if db else None
+
+def _retry_bulk_write(error, writer):
+    """BulkWriter error handler: retry each failed log write a few times"""
+    if error.attempts < WRITE_RETRIES:
+        return True
+    logger.error(f"Error writing {error.reference.path}: {error.message}")
+    return False
+
+def _on_bulk_write(reference, result, writer):
+    """BulkWriter result handler: a log has landed, so retire its account's cached usage ranges"""
+    bump_usage_version(reference.parent.parent.id)  # accounts/{id}/<logs>/{doc}
+
+def _bulk_flush_loop():
+    """Push buffered BulkWriter operations out every few seconds"""
+    while True:
+        time.sleep(BULK_FLUSH_INTERVAL)
+        try:
+            bulk_writer.flush()
+        except Exception as e:
+            logger.error(f"Error flushing bulk writer: {e}")
+
+if bulk_writer is not None:
+    bulk_writer.on_write_error(_retry_bulk_write)
+    bulk_writer.on_write_result(_on_bulk_write)
+    threading.Thread(target=_bulk_flush_loop, daemon=True).start()
+    atexit.register(bulk_writer.close)
 
 # ------------------------------- 
 # 🔹 Session Helper Functions
@@ -80,9 +417,46 @@ def require_login():
         return False
     return True
 
+# Today's date and the summary window bounds, rebuilt only when the local day rolls over
+today_info = {'expires': 0}
+
+def get_today():
+    """Today's date, its ISO string and the week/month window starts (cached until midnight)"""
+    global today_info
+    info = today_info
+    if time.time() >= info['expires']:
+        today = date.today()
+        midnight = datetime.combine(today + timedelta(days=1), datetime.min.time())
+        # Replaced as a whole so concurrent readers never see a half-updated dict
+        info = today_info = {
+            'expires': midnight.timestamp(),
+            'today': today,
+            'iso': today.isoformat(),
+            'week_ago_iso': (today - timedelta(days=7)).isoformat(),
+            'month_ago_iso': (today - timedelta(days=SUMMARY_WINDOW_DAYS)).isoformat()
+        }
+    return info
+
+@app.before_request
+def set_request_date():
+    """Fix "today" once per request so helpers agree even across midnight"""
+    info = get_today()
+    g.today = info['today']
+    g.today_iso = info['iso']
+
 # ------------------------------- 
 # 🔹 Firebase Helper Functions
 # ------------------------------- 
+# Account/subcollection references are immutable, so build each one only once;
+# bounded so arbitrary account IDs can't grow the cache
+@functools.lru_cache(maxsize=4096)
+def _account_doc(account_id):
+    return db.collection('accounts').document(account_id)
+
+@functools.lru_cache(maxsize=4096)
+def _account_subcollection(account_id, subcollection_name):
+    return _account_doc(account_id).collection(subcollection_name)
+
 def get_account_ref(account_id=None):
     """Get reference to the main account document"""
     if account_id is None:
@@ -91,11 +465,17 @@ def get_account_ref(account_id=None):
     if not account_id:
         raise ValueError("No account ID provided or in session")
     
-    return db.collection('accounts').document(account_id)
+    return _account_doc(account_id)
 
 def get_subcollection(subcollection_name, account_id=None):
     """Get reference to a subcollection under the account"""
-    return get_account_ref(account_id).collection(subcollection_name)
+    if account_id is None:
+        account_id = get_current_account_id()
+    
+    if not account_id:
+        raise ValueError("No account ID provided or in session")
+    
+    return _account_subcollection(account_id, subcollection_name)
 
 def is_significant_change(new_value, old_value, threshold):
     """Check if value changed significantly"""
@@ -103,98 +483,162 @@ def is_significant_change(new_value, old_value, threshold):
         return True
     return abs(new_value - old_value) >= threshold
 
-def add_sensor_log(sensor_id, reading_value, unit="L/min", account_id=None):
+def write_doc(doc_ref, data, batch=None, merge=False):
+    """Write a document directly, or stage it on a WriteBatch if one is given"""
+    if batch is not None:
+        batch.set(doc_ref, data, merge=merge)
+    else:
+        doc_ref.set(data, merge=merge)
+
+@retry_with_backoff
+def _commit(batch):
+    batch.commit()
+
+def bump_usage_version(account_id):
+    """Mark an account's cached usage ranges as out of date"""
+    with read_cache_lock:
+        usage_versions[account_id] = usage_versions.get(account_id, 0) + 1
+
+def write_log(doc_ref, data, batch=None):
+    """Stage a new log entry on a batch, or hand it to the background BulkWriter"""
+    bump_usage_version(doc_ref.parent.parent.id)  # accounts/{id}/<logs>/{doc}
+    if batch is not None:
+        batch.set(doc_ref, data)
+    elif bulk_writer is not None:
+        bulk_writer.create(doc_ref, data)
+    else:
+        doc_ref.set(data)
+
+def commit_batch(batch, accounts):
+    """Commit all writes staged on a WriteBatch in a single round-trip; True if it landed"""
+    try:
+        _commit(batch)
+        return True
+    except Exception as e:
+        logger.error(f"Error committing batch for {accounts}: {e}")
+        return False
+
+CLIENT_CLOCK_TOLERANCE = timedelta(days=1)  # ignore device clocks that are clearly unsynced
+
+def get_log_timestamp(client_ts=None):
+    """Timestamp for a telemetry log: the ESP32's own reading time if plausible, else ours"""
+    now = datetime.now(timezone.utc)
+    try:
+        if isinstance(client_ts, (int, float)):
+            ts = datetime.fromtimestamp(client_ts, timezone.utc)
+        elif isinstance(client_ts, str):
+            ts = datetime.fromisoformat(client_ts)
+            if ts.tzinfo is None:
+                ts = ts.replace(tzinfo=timezone.utc)
+        else:
+            return now
+        if abs(now - ts) <= CLIENT_CLOCK_TOLERANCE:
+            return ts
+    except (ValueError, OverflowError, OSError):
+        pass
+    return now
+
+def add_sensor_log(sensor_id, reading_value, unit="L/min", account_id=None, batch=None, timestamp=None):
     """Add a sensor reading to the sensor_logs subcollection"""
     try:
+        # document() allocates the ID client-side so the write can join a batch,
+        # and the readable log ID is taken from it rather than drawn separately
+        doc_ref = get_subcollection('sensor_logs', account_id).document()
         log_data = {
-            "log_id": f"LOG_{uuid.uuid4().hex[:8].upper()}",
+            "log_id": f"LOG_{doc_ref.id[:8].upper()}",
             "sensor_id_fk": sensor_id,
-            "timestamp": firestore.SERVER_TIMESTAMP,
+            # Plain client-side time: no server sentinel to resolve on high-frequency logs
+            "timestamp": timestamp or get_log_timestamp(),
             "reading_value": reading_value,
             "unit": unit
         }
-        get_subcollection('sensor_logs', account_id).add(log_data)
-        print(f"✅ Sensor log added for {account_id or 'current account'}: {reading_value} {unit}")
+        write_log(doc_ref, log_data, batch)
+        logger.info(f"✅ Sensor log added for {account_id or 'current account'}: {reading_value} {unit}")
     except Exception as e:
-        print(f"Error adding sensor log: {e}")
+        logger.error(f"Error adding sensor log: {e}")
 
-def add_control_log(action, method="Manual", account_id=None):
+def add_control_log(action, method="Manual", account_id=None, batch=None):
     """Add a pump control event to control_logs"""
     try:
+        doc_ref = get_subcollection('control_logs', account_id).document()
         log_data = {
-            "control_id": f"CTRL_{uuid.uuid4().hex[:8].upper()}",
+            "control_id": f"CTRL_{doc_ref.id[:8].upper()}",
             "control_time": firestore.SERVER_TIMESTAMP,
             "action": action,
             "method": method,
             "details": f"Pump {action} via {method}"
         }
-        get_subcollection('control_logs', account_id).add(log_data)
-        print(f"✅ Control log added for {account_id or 'current account'}: {action}")
+        write_log(doc_ref, log_data, batch)
+        logger.info(f"✅ Control log added for {account_id or 'current account'}: {action}")
     except Exception as e:
-        print(f"Error adding control log: {e}")
+        logger.error(f"Error adding control log: {e}")
 
-def add_power_log(voltage, current, battery_percent, account_id=None):
+def add_power_log(voltage, current, battery_percent, account_id=None, batch=None, timestamp=None):
     """Add battery/power reading to power_logs"""
     try:
+        doc_ref = get_subcollection('power_logs', account_id).document()
         log_data = {
-            "power_id": f"PWR_{uuid.uuid4().hex[:8].upper()}",
+            "power_id": f"PWR_{doc_ref.id[:8].upper()}",
             "power_level_V": voltage,
             "current_A": current,
             "battery_percent": battery_percent,
-            "recorded_at": firestore.SERVER_TIMESTAMP
+            "recorded_at": timestamp or get_log_timestamp()
         }
-        get_subcollection('power_logs', account_id).add(log_data)
-        print(f"✅ Power log added for {account_id or 'current account'}: {battery_percent}%")
+        write_log(doc_ref, log_data, batch)
+        logger.info(f"✅ Power log added for {account_id or 'current account'}: {battery_percent}%")
     except Exception as e:
-        print(f"Error adding power log: {e}")
+        logger.error(f"Error adding power log: {e}")
 
-def add_alert(alert_type, details, status="Active", account_id=None):
+def add_alert(alert_type, details, status="Active", account_id=None, batch=None):
     """Add an alert to the alerts subcollection"""
     try:
+        doc_ref = get_subcollection('alerts', account_id).document()
         alert_data = {
-            "alert_id": f"ALERT_{uuid.uuid4().hex[:8].upper()}",
+            "alert_id": f"ALERT_{doc_ref.id[:8].upper()}",
             "alert_type": alert_type,
             "alert_date": firestore.SERVER_TIMESTAMP,
             "status": status,
             "details": details
         }
-        get_subcollection('alerts', account_id).add(alert_data)
-        print(f"🚨 Alert added for {account_id or 'current account'}: {alert_type}")
+        write_log(doc_ref, alert_data, batch)
+        logger.info(f"🚨 Alert added for {account_id or 'current account'}: {alert_type}")
     except Exception as e:
-        print(f"Error adding alert: {e}")
+        logger.error(f"Error adding alert: {e}")
 
-def update_consumption_batch(volume_in, pump_cycles=1, account_id=None):
+def update_consumption_batch(volume_in, pump_cycles=1, account_id=None, batch=None, today_iso=None):
     """Update consumption using Firebase increments for efficiency"""
     try:
-        today = datetime.now().date().isoformat()
+        today = today_iso or get_today()['iso']
         doc_ref = get_subcollection('consumption', account_id).document(today)
-        doc = doc_ref.get()
-        
-        if doc.exists:
-            # Use Firebase Increment for atomic updates
-            doc_ref.update({
-                'consumption_total': firestore.Increment(volume_in),
-                'pump_cycles': firestore.Increment(pump_cycles),
-                'last_updated': firestore.SERVER_TIMESTAMP
-            })
-            print(f"✅ Consumption updated for {account_id or 'current account'}: +{volume_in}L")
-        else:
-            # Create new document for today
-            doc_ref.set({
-                "cons_id": f"CONS_{uuid.uuid4().hex[:8].upper()}",
-                "consumption_date": today,
-                "consumption_total": volume_in,
-                "pump_cycles": pump_cycles,
-                'last_updated': firestore.SERVER_TIMESTAMP
-            })
-            print(f"✅ Consumption created for {account_id or 'current account'} on {today}: {volume_in}L")
+        bump_usage_version(doc_ref.parent.parent.id)
+        
+        # Increment is atomic and treats missing fields as 0, and merge creates the
+        # document on first write, so no read is needed to tell the cases apart
+        write_doc(doc_ref, {
+            "cons_id": f"CONS_{today}",
+            "consumption_date": today,
+            "consumption_total": firestore.Increment(volume_in),
+            "pump_cycles": firestore.Increment(pump_cycles),
+            'last_updated': firestore.SERVER_TIMESTAMP
+        }, batch, merge=True)
+        logger.info(f"✅ Consumption updated for {account_id or 'current account'} on {today}: +{volume_in}L")
+        
+        # Keep the rolling per-day totals the dashboard summary reads in step
+        write_doc(get_daily_totals_ref(account_id), {
+            'daily_totals': {today: firestore.Increment(volume_in)},
+            'last_updated': firestore.SERVER_TIMESTAMP
+        }, batch, merge=True)
+        
+        # A direct write has landed already; a batched one drops the cached summary
+        # when its commit succeeds (see commit_account_batch)
+        if batch is None:
+            consumption_cache.pop(account_id or get_current_account_id(), None)
     except Exception as e:
-        print(f"Error updating consumption: {e}")
+        logger.error(f"Error updating consumption: {e}")
 
-def is_esp32_online(account_id=None):
-    """Check if ESP32 is online based on last update time"""
+def is_esp32_online(status):
+    """Check if ESP32 is online from a realtime status dict (updated within the last 60 seconds)"""
     try:
-        status = get_realtime_status(account_id)
         if not status:
             return False
         
@@ -222,81 +666,301 @@ def is_esp32_online(account_id=None):
         time_diff = now - last_update_dt
         return time_diff.total_seconds() < 60
     except Exception as e:
-        print(f"Error checking ESP32 status: {e}")
+        logger.error(f"Error checking ESP32 status: {e}")
         return False
 
-def get_consumption_summary(account_id=None):
-    """Calculate consumption for today, week, and month"""
+def get_daily_totals_ref(account_id=None):
+    """Reference to the rolling per-day consumption totals document"""
+    return get_subcollection('aggregates', account_id).document('summary')
+
+@firestore.transactional
+def _rebuild_daily_totals(transaction, totals_ref, recent_query, since_iso):
+    """Fill the totals document from consumption records unless that has already been done"""
+    totals_doc = totals_ref.get(transaction=transaction)
+    totals = totals_doc.to_dict() if totals_doc.exists else {}
+    if totals.get('rebuilt'):
+        return totals.get('daily_totals', {})
+    
+    daily_totals = {}
+    for doc in recent_query.get(transaction=transaction):
+        data = doc.to_dict()
+        date_str = data.get('consumption_date')
+        if date_str:
+            daily_totals[date_str] = daily_totals.get(date_str, 0) + (data.get('consumption_total', 0) or 0)
+    
+    # Consumption records get the same increments as this document, so they are the
+    # authority for every day they cover; other days are kept unless they have expired
+    kept = {date_str: total for date_str, total in totals.get('daily_totals', {}).items() if date_str >= since_iso}
+    expired = {date_str: firestore.DELETE_FIELD for date_str in totals.get('daily_totals', {}) if date_str < since_iso}
+    transaction.set(totals_ref, {
+        'daily_totals': {**expired, **daily_totals},
+        'rebuilt': True,
+        'last_updated': firestore.SERVER_TIMESTAMP
+    }, merge=True)
+    return {**kept, **daily_totals}
+
+def rebuild_daily_totals(account_id, since_iso):
+    """Build the per-day totals document from consumption records (first use only)"""
+    # consumption_date is stored as YYYY-MM-DD, which sorts lexicographically,
+    # so Firestore can return just the recent records instead of the full history.
+    # There is one record per day, so the 30-day window plus today is at most 31
+    # documents; the cap keeps the read bounded even if stray future-dated ones exist.
+    consumption_ref = get_subcollection('consumption', account_id)
+    recent_query = consumption_ref.where('consumption_date', '>=', since_iso) \
+        .order_by('consumption_date', direction=firestore.Query.DESCENDING) \
+        .limit(SUMMARY_WINDOW_DAYS + 1)
+    
+    # A transaction, so an increment committed meanwhile makes it retry instead of being lost
+    daily_totals = _rebuild_daily_totals(db.transaction(), get_daily_totals_ref(account_id), recent_query, since_iso)
+    logger.info(f"📈 Daily totals rebuilt for {account_id}: {len(daily_totals)} days")
+    return daily_totals
+
+def get_consumption_summary(account_id=None, today=None, totals_doc=None):
+    """Calculate consumption for today, week, and month (from totals_doc if already fetched)"""
     try:
-        today = datetime.now().date()
-        week_ago = today - timedelta(days=7)
-        month_ago = today - timedelta(days=30)
+        if account_id is None:
+            account_id = get_current_account_id()
         
-        consumption_ref = get_subcollection('consumption', account_id)
-        all_records = consumption_ref.get()
+        # Dashboard polls this every few seconds; serve repeats from memory
+        cached = consumption_cache.get(account_id)
+        if cached and time.monotonic() - cached[0] < CONSUMPTION_CACHE_TTL:
+            return cached[1]
+        
+        info = get_today()
+        if today is None or today == info['today']:
+            today_iso, week_ago_iso, month_ago_iso = info['iso'], info['week_ago_iso'], info['month_ago_iso']
+        else:
+            today_iso = today.isoformat()
+            week_ago_iso = (today - timedelta(days=7)).isoformat()
+            month_ago_iso = (today - timedelta(days=SUMMARY_WINDOW_DAYS)).isoformat()
+        
+        # One document holds the per-day totals, kept current by update_consumption_batch
+        if totals_doc is None:
+            totals_doc = get_daily_totals_ref(account_id).get()
+        # The first status post after deploy creates the document with only that day's
+        # increment, so history is backfilled until the rebuilt marker is present
+        totals = totals_doc.to_dict() if totals_doc.exists else {}
+        if totals.get('rebuilt'):
+            daily_totals = totals.get('daily_totals', {})
+        else:
+            daily_totals = rebuild_daily_totals(account_id, month_ago_iso)
         
         today_total = 0
         week_total = 0
         month_total = 0
+        expired = []
         
-        for doc in all_records:
-            data = doc.to_dict()
-            try:
-                date_str = data.get('consumption_date')
-                record_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                consumption = data.get('consumption_total', 0)
-                
-                if record_date == today:
-                    today_total += consumption
-                if week_ago <= record_date <= today:
-                    week_total += consumption
-                if month_ago <= record_date <= today:
-                    month_total += consumption
-            except Exception:
+        for date_str, consumption in daily_totals.items():
+            if date_str < month_ago_iso:
+                expired.append(date_str)
                 continue
-        
-        return {
+            if date_str > today_iso:
+                continue
+            
+            if date_str == today_iso:
+                today_total += consumption
+            if date_str >= week_ago_iso:
+                week_total += consumption
+            month_total += consumption
+        
+        # Drop days that have rolled out of the month window, off the request path
+        if expired:
+            prune = PendingWrites()
+            prune.set(get_daily_totals_ref(account_id), {
+                'daily_totals': {date_str: firestore.DELETE_FIELD for date_str in expired}
+            }, merge=True)
+            enqueue_batch(prune, account_id)
+        
+        summary = {
             "consumption_day": round(today_total, 2),
             "consumption_week": round(week_total, 2),
             "consumption_month": round(month_total, 2)
         }
+        cache_put(consumption_cache, account_id, summary)
+        return summary
     except Exception as e:
-        print(f"Error calculating consumption: {e}")
+        logger.error(f"Error calculating consumption: {e}")
         return {
             "consumption_day": 0,
             "consumption_week": 0,
             "consumption_month": 0
         }
 
-def get_realtime_status(account_id=None):
-    """Get current real-time status from Firebase"""
+def get_realtime_status(account_id=None, status_doc=None):
+    """Get current real-time status from Firebase (from status_doc if already fetched)"""
     try:
-        status_doc = get_subcollection('realtime_status', account_id).document('current').get()
-        if status_doc.exists:
-            return status_doc.to_dict()
-        return None
+        if account_id is None:
+            account_id = get_current_account_id()
+        
+        cached = status_cache.get(account_id)
+        if cached and (has_live_status(account_id) or time.monotonic() - cached[0] < STATUS_CACHE_TTL):
+            return cached[1]
+        
+        if status_doc is None:
+            status_doc = get_subcollection('realtime_status', account_id).document('current').get()
+        status = status_doc.to_dict() if status_doc.exists else None
+        cache_put(status_cache, account_id, status)
+        return status
     except Exception as e:
-        print(f"Error getting realtime status: {e}")
+        logger.error(f"Error getting realtime status: {e}")
         return None
 
-def update_realtime_status(data, account_id=None):
-    """Update the real-time status document"""
+def is_cache_fresh(cache, key, ttl):
+    """Check whether a (cached_at, value) cache holds a live entry for key"""
+    cached = cache.get(key)
+    return bool(cached) and time.monotonic() - cached[0] < ttl
+
+def get_dashboard_data(account_id, today=None):
+    """Read the consumption summary and realtime status, fetching both documents in one call"""
+    watch_status(account_id)
+    if is_cache_fresh(consumption_cache, account_id, CONSUMPTION_CACHE_TTL) or \
+            is_cache_fresh(status_cache, account_id, STATUS_CACHE_TTL) or has_live_status(account_id):
+        # At least one is served from memory; the other is a single read anyway
+        return get_consumption_summary(account_id, today), get_realtime_status(account_id)
+    
+    status_ref = get_subcollection('realtime_status', account_id).document('current')
+    totals_ref = get_daily_totals_ref(account_id)
+    try:
+        docs = {doc.reference.path: doc for doc in db.get_all([status_ref, totals_ref])}
+    except Exception as e:
+        logger.error(f"Error fetching dashboard documents: {e}")
+        docs = {}
+    
+    return (get_consumption_summary(account_id, today, totals_doc=docs.get(totals_ref.path)),
+            get_realtime_status(account_id, status_doc=docs.get(status_ref.path)))
+
+def update_realtime_status(data, account_id=None, batch=None, persist=True):
+    """Update the real-time status document (only the cached copy when persist is False)"""
     try:
         data['last_update'] = firestore.SERVER_TIMESTAMP
         data['esp32_online'] = True  # Mark ESP32 as online when it sends data
-        get_subcollection('realtime_status', account_id).document('current').set(data, merge=True)
+        if persist:
+            write_doc(get_subcollection('realtime_status', account_id).document('current'), data, batch, merge=True)
+        
+        # Write-through: merge into the cached copy so dashboard reads stay free.
+        # Without a cached copy we don't know the other fields, so just drop it.
+        if account_id is None:
+            account_id = get_current_account_id()
+        cached = status_cache.get(account_id)
+        if cached and cached[1] is not None:
+            status = {**cached[1], **data, 'last_update': datetime.now(timezone.utc)}
+            cache_put(status_cache, account_id, status)
+        else:
+            status_cache.pop(account_id, None)
     except Exception as e:
-        print(f"Error updating realtime status: {e}")
+        logger.error(f"Error updating realtime status: {e}")
+
+# One Firestore listener per account, fanned out to every open dashboard stream and
+# kept for a while after the last dashboard read so polled pages come from memory too
+# account_id -> {'watch': Watch, 'clients': set of queue.Queue, 'expires': monotonic time}
+status_listeners = {}
+status_listeners_lock = threading.Lock()
+STATUS_LISTENER_IDLE = 300       # seconds a listener outlives the last dashboard read
+
+def has_live_status(account_id):
+    """True while a snapshot listener keeps this account's cached status current"""
+    return account_id in status_listeners and account_id in status_cache
+
+def _make_status_callback(account_id):
+    """Snapshot callback that refreshes the cache and notifies stream clients"""
+    def on_snapshot(doc_snapshots, changes, read_time):
+        for snapshot in doc_snapshots:
+            status = snapshot.to_dict() if snapshot.exists else None
+            cache_put(status_cache, account_id, status)
+            with status_listeners_lock:
+                listener = status_listeners.get(account_id)
+                clients = list(listener['clients']) if listener else []
+            for client in clients:
+                try:
+                    client.put_nowait(status)
+                except queue.Full:
+                    pass  # Slow client; it will catch up on the next change
+    return on_snapshot
+
+def _start_status_listener(account_id):
+    """Open an account's snapshot listener (status_listeners_lock must be held)"""
+    listener = status_listeners[account_id] = {'watch': None, 'clients': set(), 'expires': 0}
+    status_doc = get_subcollection('realtime_status', account_id).document('current')
+    listener['watch'] = status_doc.on_snapshot(_make_status_callback(account_id))
+    logger.info(f"📡 Status listener started for {account_id}")
+    return listener
+
+def _stop_idle_status_listeners(now):
+    """Close listeners with no stream clients whose idle window has passed (lock must be held)"""
+    for account_id, listener in list(status_listeners.items()):
+        if listener['clients'] or listener['expires'] > now:
+            continue
+        del status_listeners[account_id]
+        try:
+            listener['watch'].unsubscribe()
+        except Exception as e:
+            logger.error(f"Error stopping status listener: {e}")
+        logger.info(f"📡 Status listener stopped for {account_id}")
+
+def watch_status(account_id):
+    """Keep an account's listener running while its dashboard is being read"""
+    now = time.monotonic()
+    with status_listeners_lock:
+        listener = status_listeners.get(account_id) or _start_status_listener(account_id)
+        listener['expires'] = now + STATUS_LISTENER_IDLE
+        _stop_idle_status_listeners(now)
+
+def subscribe_status(account_id):
+    """Register a stream client for an account's status changes"""
+    client = queue.Queue(maxsize=10)
+    with status_listeners_lock:
+        listener = status_listeners.get(account_id) or _start_status_listener(account_id)
+        listener['clients'].add(client)
+    return client
+
+def unsubscribe_status(account_id, client):
+    """Remove a stream client, stopping the listener once nothing is using it"""
+    with status_listeners_lock:
+        listener = status_listeners.get(account_id)
+        if listener is None:
+            return
+        listener['clients'].discard(client)
+        _stop_idle_status_listeners(time.monotonic())
 
 def get_command(account_id=None):
     """Get the current command for ESP32"""
     try:
+        if account_id is None:
+            account_id = get_current_account_id()
+        
+        # Every ESP32 post asks for this, but the document rarely changes
+        cached = command_cache.get(account_id)
+        if cached and time.monotonic() - cached[0] < COMMAND_CACHE_TTL:
+            if not cached[1] or cached[1].get('status') != 'pending':
+                return cached[1]
+        
         cmd_doc = get_subcollection('commands', account_id).document('control').get()
-        if cmd_doc.exists:
-            return cmd_doc.to_dict()
+        cmd = cmd_doc.to_dict() if cmd_doc.exists else None
+        cache_put(command_cache, account_id, cmd)
+        return cmd
+    except Exception as e:
+        logger.error(f"Error getting command: {e}")
         return None
+
+@firestore.transactional
+def _claim_pending_command(transaction, cmd_ref):
+    """Atomically flip a pending command to delivered; returns its action or None"""
+    snapshot = cmd_ref.get(transaction=transaction)
+    cmd = snapshot.to_dict() if snapshot.exists else None
+    if cmd and cmd.get('status') == 'pending':
+        transaction.update(cmd_ref, {'status': 'delivered'})
+        return cmd.get('action')
+    return None
+
+def claim_pending_command(account_id=None):
+    """Mark the pending command as delivered unless someone else got there first"""
+    try:
+        cmd_ref = get_subcollection('commands', account_id).document('control')
+        action = _claim_pending_command(db.transaction(), cmd_ref)
+        command_cache.pop(account_id or get_current_account_id(), None)
+        return action
     except Exception as e:
-        print(f"Error getting command: {e}")
+        logger.error(f"Error claiming command: {e}")
         return None
 
 def set_command(action, account_id=None):
@@ -308,42 +972,155 @@ def set_command(action, account_id=None):
             "status": "pending"
         }
         get_subcollection('commands', account_id).document('control').set(cmd_data)
+        command_cache.pop(account_id or get_current_account_id(), None)
     except Exception as e:
-        print(f"Error setting command: {e}")
+        logger.error(f"Error setting command: {e}")
 
 # ------------------------------- 
 # 🔹 User Authentication
 # ------------------------------- 
+HASHED_PASSWORD_PREFIXES = ("scrypt:", "pbkdf2:")
+# PBKDF2-HMAC-SHA256 runs in OpenSSL, which uses the CPU's SHA instructions where
+# available; older scrypt hashes still verify through check_password_hash
+PASSWORD_HASH_METHOD = "pbkdf2:sha256"
+
+def hash_password(password):
+    """Hash a password for storage"""
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+def is_legacy_password(stored_password):
+    """Older accounts stored the password itself instead of a hash"""
+    return not stored_password.startswith(HASHED_PASSWORD_PREFIXES)
+
+# Checked against when the email is unknown, so a miss costs as much as a wrong password
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_hex(16))
+
+def verify_password(user, password):
+    """Check a password against the user's stored hash (or legacy plain-text value)"""
+    if not user:
+        check_password_hash(DUMMY_PASSWORD_HASH, password)
+        return False
+    
+    stored_password = user.get("password_hash") or ""
+    if is_legacy_password(stored_password):
+        return hmac.compare_digest(stored_password.encode(), password.encode())
+    return check_password_hash(stored_password, password)
+
+def normalize_email(email):
+    """Normalize an email address so lookups are case-insensitive"""
+    return (email or "").strip().lower()
+
+def get_email_index_ref(email):
+    """Get the email_index pointer document for an email address"""
+    digest = hashlib.sha256(normalize_email(email).encode()).hexdigest()
+    return db.collection('email_index').document(digest)
+
 def get_user_by_email(email):
     """Get user from Firebase by email"""
+    key = normalize_email(email)
+    cached = user_cache.get(key)
+    if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+        return dict(cached[1])
+    
+    user_data = fetch_user_by_email(email)
+    if user_data:
+        cache_put(user_cache, key, dict(user_data))
+    return user_data
+
+def fetch_user_by_email(email):
+    """Read a user from Firestore by email, bypassing the cache"""
     try:
+        # Two point reads through the email index instead of a query on every login
+        index_doc = get_email_index_ref(email).get()
+        if index_doc.exists:
+            user_doc = db.collection('users').document(index_doc.get('user_id')).get()
+            if user_doc.exists and normalize_email(user_doc.get('email')) == normalize_email(email):
+                user_data = user_doc.to_dict()
+                user_data['doc_id'] = user_doc.id  # Include document ID
+                return user_data
+        
+        # Users registered before the index existed: query once, then backfill. Their
+        # stored email may not be lowercased, so match the address as typed as well;
+        # other spellings are only found once migrate_email_index.py has run
         users_ref = db.collection('users')
-        query = users_ref.where('email', '==', email).limit(1).get()
+        spellings = list(dict.fromkeys([(email or "").strip(), normalize_email(email)]))
+        query = users_ref.where('email', 'in', spellings).limit(1).get()
         if query:
             user_doc = query[0]
             user_data = user_doc.to_dict()
             user_data['doc_id'] = user_doc.id  # Include document ID
+            get_email_index_ref(email).set({'user_id': user_doc.id})
             return user_data
         return None
     except Exception as e:
-        print(f"Error getting user: {e}")
+        logger.error(f"Error getting user: {e}")
         return None
 
 # ------------------------------- 
 # 🔹 Usage Summary Functions
 # ------------------------------- 
+# Shared pool for independent Firestore queries a single request issues side by side
+read_executor = ThreadPoolExecutor(max_workers=8)
+USAGE_LOG_ROWS = 100             # newest sensor/power/control rows returned per range
+
+def make_usage_parser(fields, timestamp_field=None):
+    """Build a document -> row converter for one usage collection.
+    fields maps each output key to its (source field, default); the timestamp is rendered as text."""
+    items = tuple(fields.items())
+    def parse(doc):
+        data = doc.to_dict()
+        row = {'timestamp': str(data.get(timestamp_field))} if timestamp_field else {}
+        for key, (source, default) in items:
+            row[key] = data.get(source, default) or default
+        return row
+    # Source fields, for projecting the query down to what the parser reads
+    parse.fields = [source for source, _ in fields.values()] + ([timestamp_field] if timestamp_field else [])
+    return parse
+
+parse_consumption_doc = make_usage_parser({
+    'date': ('consumption_date', None),
+    'consumption_total': ('consumption_total', 0),
+    'pump_cycles': ('pump_cycles', 0),
+})
+parse_sensor_doc = make_usage_parser({
+    'reading_value': ('reading_value', 0),
+    'unit': ('unit', 'L/min'),
+    'sensor_id': ('sensor_id_fk', 'Unknown'),
+}, 'timestamp')
+parse_power_doc = make_usage_parser({
+    'voltage': ('power_level_V', 0),
+    'current': ('current_A', 0),
+    'battery_percent': ('battery_percent', 0),
+}, 'recorded_at')
+parse_control_doc = make_usage_parser({
+    'action': ('action', 'Unknown'),
+    'method': ('method', 'Unknown'),
+    'details': ('details', ''),
+}, 'control_time')
+parse_alert_doc = make_usage_parser({
+    'alert_type': ('alert_type', 'Unknown'),
+    'status': ('status', 'Unknown'),
+    'details': ('details', ''),
+}, 'alert_date')
+
 def get_usage_data_by_date_range(start_date, end_date, account_id=None):
     """Get all usage data within a date range"""
     if account_id is None:
         account_id = get_current_account_id()
     
-    print(f"📊 Fetching usage data for account: {account_id}")
-    print(f"📅 Date range: {start_date} to {end_date}")
+    logger.info(f"📊 Fetching usage data for account: {account_id}")
+    logger.info(f"📅 Date range: {start_date} to {end_date}")
     
     if not account_id:
-        print("❌ No account_id provided!")
+        logger.error("❌ No account_id provided!")
         return None
     
+    # Re-downloads of the same range are served from memory until the account logs something new
+    cache_key = (account_id, start_date, end_date, usage_versions.get(account_id, 0))
+    cached = usage_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < USAGE_CACHE_TTL:
+        return cached[1]
+    
     try:
         consumption_ref = get_subcollection('consumption', account_id)
         sensor_ref = get_subcollection('sensor_logs', account_id)
@@ -352,155 +1129,80 @@ def get_usage_data_by_date_range(start_date, end_date, account_id=None):
         alerts_ref = get_subcollection('alerts', account_id)
         
         # Parse dates
-        start = datetime.strptime(start_date, "%Y-%m-%d").date()
-        end = datetime.strptime(end_date, "%Y-%m-%d").date()
-        
-        # Get consumption data
-        consumption_data = []
-        consumption_docs = consumption_ref.get()
-        print(f"📦 Found {len(consumption_docs)} total consumption records")
-        for doc in consumption_docs:
-            data = doc.to_dict()
-            try:
-                date_str = data.get('consumption_date')
-                if date_str:
-                    record_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    if start <= record_date <= end:
-                        consumption_data.append({
-                            'date': date_str,
-                            'consumption_total': data.get('consumption_total', 0) or 0,
-                            'pump_cycles': data.get('pump_cycles', 0) or 0
-                        })
-            except Exception as e:
-                print(f"⚠️ Error parsing consumption: {e}")
-                continue
+        start = date.fromisoformat(start_date)
+        end = date.fromisoformat(end_date)
+        # Normalized YYYY-MM-DD bounds compare correctly as plain strings
+        start_iso = start.isoformat()
+        end_iso = end.isoformat()
+        # Log timestamps are stored in UTC, so the requested days are UTC days
+        start_dt = datetime(start.year, start.month, start.day, tzinfo=timezone.utc)
+        end_dt = datetime(end.year, end.month, end.day, tzinfo=timezone.utc) + timedelta(days=1)
+        
+        def in_range(ref, field):
+            """Query for the documents inside the requested days"""
+            return ref.where(field, '>=', start_dt).where(field, '<', end_dt)
+        
+        def newest_in_range(ref, field, fields):
+            """Fetch only the newest USAGE_LOG_ROWS documents in range, projected to the fields read below"""
+            query = in_range(ref, field).select(fields).order_by(field, direction=firestore.Query.DESCENDING)
+            return read_executor.submit(query.limit(USAGE_LOG_ROWS).get)
+        
+        def count_in_range(ref, field):
+            """Count the documents in range on the server instead of downloading them"""
+            return read_executor.submit(in_range(ref, field).count(alias='total').get)
+        
+        # Start every query at once; each result is awaited only when it's parsed
+        consumption_future = read_executor.submit(
+            consumption_ref.select(parse_consumption_doc.fields)
+            .where('consumption_date', '>=', start_iso).where('consumption_date', '<=', end_iso).get
+        )
+        sensor_future = newest_in_range(sensor_ref, 'timestamp', parse_sensor_doc.fields)
+        power_future = newest_in_range(power_ref, 'recorded_at', parse_power_doc.fields)
+        control_future = newest_in_range(control_ref, 'control_time', parse_control_doc.fields)
+        sensor_count_future = count_in_range(sensor_ref, 'timestamp')
+        # Power logs are counted and their battery level averaged in one aggregation query
+        power_stats_future = read_executor.submit(
+            in_range(power_ref, 'recorded_at').count(alias='total').avg('battery_percent', alias='battery').get
+        )
+        control_count_future = count_in_range(control_ref, 'control_time')
+        alerts_future = read_executor.submit(
+            in_range(alerts_ref, 'alert_date').select(parse_alert_doc.fields).get
+        )
         
-        # Sort by date
-        consumption_data.sort(key=lambda x: x['date'])
-        print(f"   - In date range: {len(consumption_data)}")
+        # Get consumption data (one document per day, returned in date order)
+        consumption_docs = consumption_future.result()
+        logger.info(f"📦 Found {len(consumption_docs)} consumption records in range")
+        consumption_data = list(map(parse_consumption_doc, consumption_docs))
         
+        # Log tables only show the newest rows (fetched newest first); the rest are just counted
         # Get sensor logs
-        sensor_logs = []
-        sensor_docs = sensor_ref.get()
-        print(f"📦 Found {len(sensor_docs)} total sensor logs")
-        for doc in sensor_docs:
-            data = doc.to_dict()
-            timestamp = data.get('timestamp')
-            if timestamp:
-                try:
-                    # Handle Firestore timestamp
-                    if hasattr(timestamp, 'date'):
-                        log_date = timestamp.date()
-                    elif hasattr(timestamp, 'strftime'):
-                        log_date = timestamp.date() if hasattr(timestamp, 'date') else datetime.fromisoformat(str(timestamp)[:10]).date()
-                    else:
-                        log_date = datetime.strptime(str(timestamp)[:10], "%Y-%m-%d").date()
-                    
-                    if start <= log_date <= end:
-                        sensor_logs.append({
-                            'timestamp': str(timestamp),
-                            'reading_value': data.get('reading_value', 0) or 0,
-                            'unit': data.get('unit', 'L/min'),
-                            'sensor_id': data.get('sensor_id_fk', 'Unknown')
-                        })
-                except Exception as e:
-                    print(f"⚠️ Error parsing sensor log: {e}")
-                    continue
-        print(f"   - In date range: {len(sensor_logs)}")
+        sensor_count = sensor_count_future.result()[0][0].value
+        logger.info(f"📦 Found {sensor_count} sensor logs in range")
+        sensor_logs = list(map(parse_sensor_doc, reversed(sensor_future.result())))
         
         # Get power logs
-        power_logs = []
-        power_docs = power_ref.get()
-        print(f"📦 Found {len(power_docs)} total power logs")
-        for doc in power_docs:
-            data = doc.to_dict()
-            timestamp = data.get('recorded_at')
-            if timestamp:
-                try:
-                    if hasattr(timestamp, 'date'):
-                        log_date = timestamp.date()
-                    elif hasattr(timestamp, 'strftime'):
-                        log_date = timestamp.date() if hasattr(timestamp, 'date') else datetime.fromisoformat(str(timestamp)[:10]).date()
-                    else:
-                        log_date = datetime.strptime(str(timestamp)[:10], "%Y-%m-%d").date()
-                    
-                    if start <= log_date <= end:
-                        power_logs.append({
-                            'timestamp': str(timestamp),
-                            'voltage': data.get('power_level_V', 0) or 0,
-                            'current': data.get('current_A', 0) or 0,
-                            'battery_percent': data.get('battery_percent', 0) or 0
-                        })
-                except Exception as e:
-                    print(f"⚠️ Error parsing power log: {e}")
-                    continue
-        print(f"   - In date range: {len(power_logs)}")
+        power_stats = {result.alias: result.value for result in power_stats_future.result()[0]}
+        power_count = power_stats['total']
+        logger.info(f"📦 Found {power_count} power logs in range")
+        power_logs = list(map(parse_power_doc, reversed(power_future.result())))
         
         # Get control logs
-        control_logs = []
-        control_docs = control_ref.get()
-        print(f"📦 Found {len(control_docs)} total control logs")
-        for doc in control_docs:
-            data = doc.to_dict()
-            timestamp = data.get('control_time')
-            if timestamp:
-                try:
-                    if hasattr(timestamp, 'date'):
-                        log_date = timestamp.date()
-                    elif hasattr(timestamp, 'strftime'):
-                        log_date = timestamp.date() if hasattr(timestamp, 'date') else datetime.fromisoformat(str(timestamp)[:10]).date()
-                    else:
-                        log_date = datetime.strptime(str(timestamp)[:10], "%Y-%m-%d").date()
-                    
-                    if start <= log_date <= end:
-                        control_logs.append({
-                            'timestamp': str(timestamp),
-                            'action': data.get('action', 'Unknown'),
-                            'method': data.get('method', 'Unknown'),
-                            'details': data.get('details', '') or ''
-                        })
-                except Exception as e:
-                    print(f"⚠️ Error parsing control log: {e}")
-                    continue
-        print(f"   - In date range: {len(control_logs)}")
+        control_count = control_count_future.result()[0][0].value
+        logger.info(f"📦 Found {control_count} control logs in range")
+        control_logs = list(map(parse_control_doc, reversed(control_future.result())))
         
         # Get alerts
-        alerts = []
-        alerts_docs = alerts_ref.get()
-        print(f"📦 Found {len(alerts_docs)} total alerts")
-        for doc in alerts_docs:
-            data = doc.to_dict()
-            timestamp = data.get('alert_date')
-            if timestamp:
-                try:
-                    if hasattr(timestamp, 'date'):
-                        log_date = timestamp.date()
-                    elif hasattr(timestamp, 'strftime'):
-                        log_date = timestamp.date() if hasattr(timestamp, 'date') else datetime.fromisoformat(str(timestamp)[:10]).date()
-                    else:
-                        log_date = datetime.strptime(str(timestamp)[:10], "%Y-%m-%d").date()
-                    
-                    if start <= log_date <= end:
-                        alerts.append({
-                            'timestamp': str(timestamp),
-                            'alert_type': data.get('alert_type', 'Unknown'),
-                            'status': data.get('status', 'Unknown'),
-                            'details': data.get('details', '') or ''
-                        })
-                except Exception as e:
-                    print(f"⚠️ Error parsing alert: {e}")
-                    continue
-        print(f"   - In date range: {len(alerts)}")
+        alerts_docs = alerts_future.result()
+        logger.info(f"📦 Found {len(alerts_docs)} alerts in range")
+        alerts = list(map(parse_alert_doc, alerts_docs))
         
         # Calculate summary statistics
         total_consumption = sum(c['consumption_total'] for c in consumption_data) if consumption_data else 0
         total_pump_cycles = sum(c['pump_cycles'] for c in consumption_data) if consumption_data else 0
         avg_daily_consumption = total_consumption / len(consumption_data) if consumption_data else 0
         
-        # Calculate average battery if power logs exist
-        avg_battery = 0
-        if power_logs:
-            avg_battery = sum(p['battery_percent'] for p in power_logs) / len(power_logs)
+        # Average battery over every power log in range, not just the rows shown (None when there are none)
+        avg_battery = power_stats['battery'] or 0
         
         result = {
             'summary': {
@@ -512,24 +1214,23 @@ def get_usage_data_by_date_range(start_date, end_date, account_id=None):
                 'avg_daily_consumption': round(avg_daily_consumption, 2),
                 'avg_battery_percent': round(avg_battery, 1),
                 'total_alerts': len(alerts),
-                'total_sensor_logs': len(sensor_logs),
-                'total_power_logs': len(power_logs),
-                'total_control_logs': len(control_logs)
+                'total_sensor_logs': sensor_count,
+                'total_power_logs': power_count,
+                'total_control_logs': control_count
             },
             'consumption': consumption_data,
-            'sensor_logs': sensor_logs[-100:],  # Limit to last 100
-            'power_logs': power_logs[-100:],
-            'control_logs': control_logs[-100:],
+            'sensor_logs': sensor_logs,
+            'power_logs': power_logs,
+            'control_logs': control_logs,
             'alerts': alerts
         }
         
-        print(f"✅ Usage data fetched successfully!")
+        logger.info(f"✅ Usage data fetched successfully!")
+        cache_put(usage_cache, cache_key, result)
         return result
         
     except Exception as e:
-        print(f"❌ Error getting usage data: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Error getting usage data: {e}")
         # Return empty structure instead of None
         return {
             'summary': {
@@ -561,11 +1262,12 @@ def index():
         return redirect(url_for('login'))
     
     try:
-        # Get consumption summary for current user's account
-        consumption = get_consumption_summary()
+        # Get consumption summary and last known status for current user's account
+        consumption, status = get_dashboard_data(get_current_account_id(), g.today)
+        
+        # Check if ESP32 is online
+        esp32_online = is_esp32_online(status)
         
-        # Get last known status
-        status = get_realtime_status()
         if not status:
             status = {
                 "pump_state": "N/A",
@@ -576,9 +1278,6 @@ def index():
                 "esp32_online": False
             }
         
-        # Check if ESP32 is online
-        esp32_online = is_esp32_online()
-        
         display_status = {
             "pump": status.get("pump_state", "N/A"),
             "flow_in": status.get("flow_in_L_min", 0),
@@ -600,7 +1299,7 @@ def index():
                              device_name=session.get("device_name", "AquaSolar"),
                              account_id=session.get("account_id"))
     except Exception as e:
-        print(f"Error loading dashboard: {e}")
+        logger.error(f"Error loading dashboard: {e}")
         return render_template("dashboard.html", 
                              status={},
                              user_name=session.get("user_name"),
@@ -619,7 +1318,7 @@ def get_usage_summary():
         account_id = get_current_account_id()
         
         if not account_id:
-            print("❌ No account_id in session!")
+            logger.error("❌ No account_id in session!")
             return jsonify({"error": "No account found. Please log in again."}), 403
         
         # Get date range from query parameters
@@ -628,11 +1327,11 @@ def get_usage_summary():
         
         # Default to last 30 days if not specified
         if not end_date:
-            end_date = datetime.now().date().isoformat()
+            end_date = g.today_iso
         if not start_date:
-            start_date = (datetime.now().date() - timedelta(days=30)).isoformat()
+            start_date = get_today()['month_ago_iso']
         
-        print(f"📊 API request - Account: {account_id}, Range: {start_date} to {end_date}")
+        logger.info(f"📊 API request - Account: {account_id}, Range: {start_date} to {end_date}")
         
         # Get usage data
         usage_data = get_usage_data_by_date_range(start_date, end_date, account_id)
@@ -663,11 +1362,30 @@ def get_usage_summary():
         return jsonify(usage_data)
             
     except Exception as e:
-        print(f"❌ Error getting usage summary: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Error getting usage summary: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Report title for each CSV download type
+CSV_REPORT_TYPES = {
+    'consumption': 'WATER CONSUMPTION REPORT',
+    'sensor': 'SENSOR READINGS REPORT',
+    'power': 'POWER & BATTERY REPORT',
+    'control': 'PUMP CONTROL LOG REPORT',
+    'alerts': 'SYSTEM ALERTS REPORT',
+    'summary': 'EXECUTIVE SUMMARY REPORT',
+}
+
+class CSVLineEcho:
+    """Stand-in file for csv.writer: writerow returns the formatted line instead of buffering it"""
+    def write(self, line):
+        return line
+
+def csv_rows_chunk(rows):
+    """Format a whole table with one writerows call and return it as a single chunk"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
 @app.route("/api/download-csv", methods=["GET"])
 def download_csv():
     """Download usage data as CSV with formal accounting-style formatting"""
@@ -679,11 +1397,14 @@ def download_csv():
         end_date = request.args.get('end_date')
         data_type = request.args.get('type', 'consumption')
         
+        if data_type not in CSV_REPORT_TYPES:
+            return jsonify({"error": "Invalid data type"}), 400
+        
         # Default dates
         if not end_date:
-            end_date = datetime.now().date().isoformat()
+            end_date = g.today_iso
         if not start_date:
-            start_date = (datetime.now().date() - timedelta(days=30)).isoformat()
+            start_date = get_today()['month_ago_iso']
         
         usage_data = get_usage_data_by_date_range(start_date, end_date)
         
@@ -695,346 +1416,274 @@ def download_csv():
         device_name = session.get('device_name', 'AquaSolar')
         account_id = session.get('account_id', 'N/A')
         
-        # Create CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
         # Generate report timestamp
         report_date = datetime.now().strftime('%B %d, %Y at %I:%M %p')
         
-        if data_type == 'consumption':
-            # Header Section
-            writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'])
-            writer.writerow(['WATER CONSUMPTION REPORT'])
-            writer.writerow([])
-            writer.writerow(['Report Details'])
-            writer.writerow(['Account Holder:', user_name])
-            writer.writerow(['Device Name:', device_name])
-            writer.writerow(['Account ID:', account_id])
-            writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-            writer.writerow(['Generated:', report_date])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Summary Section
-            summary = usage_data['summary']
-            writer.writerow(['SUMMARY'])
-            writer.writerow(['Total Days in Period:', summary['total_days']])
-            writer.writerow(['Total Water Consumption:', f"{summary['total_consumption']} L"])
-            writer.writerow(['Average Daily Consumption:', f"{summary['avg_daily_consumption']} L"])
-            writer.writerow(['Total Pump Cycles:', summary['total_pump_cycles']])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Data Table
-            writer.writerow(['DAILY CONSUMPTION DETAILS'])
-            writer.writerow([])
-            writer.writerow(['Date', 'Water Consumed (L)', 'Pump Cycles', 'Notes'])
-            writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 30])
+        def generate():
+            # Every writerow hands back its formatted line, which goes out as soon as it is built
+            writer = csv.writer(CSVLineEcho())
             
-            total_consumption = 0
-            total_cycles = 0
+            # Header Section, shared by every report type
+            for row in (['AQUASOLAR WATER MONITORING SYSTEM'],
+                        [CSV_REPORT_TYPES[data_type]],
+                        [],
+                        ['Report Details'],
+                        ['Account Holder:', user_name],
+                        ['Device Name:', device_name],
+                        ['Account ID:', account_id],
+                        ['Report Period:', f"{start_date} to {end_date}"],
+                        ['Generated:', report_date],
+                        [],
+                        ['=' * 80],
+                        []):
+                yield writer.writerow(row)
             
-            for row in usage_data['consumption']:
-                notes = ''
-                if row['consumption_total'] > summary['avg_daily_consumption'] * 1.5:
-                    notes = 'Above average usage'
-                elif row['consumption_total'] == 0:
-                    notes = 'No usage recorded'
+            if data_type == 'consumption':
+                # Summary Section
+                summary = usage_data['summary']
+                yield writer.writerow(['SUMMARY'])
+                yield writer.writerow(['Total Days in Period:', summary['total_days']])
+                yield writer.writerow(['Total Water Consumption:', f"{summary['total_consumption']} L"])
+                yield writer.writerow(['Average Daily Consumption:', f"{summary['avg_daily_consumption']} L"])
+                yield writer.writerow(['Total Pump Cycles:', summary['total_pump_cycles']])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
                 
-                writer.writerow([
-                    row['date'], 
-                    f"{row['consumption_total']:.2f}", 
-                    row['pump_cycles'],
-                    notes
-                ])
-                total_consumption += row['consumption_total']
-                total_cycles += row['pump_cycles']
-            
-            writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 30])
-            writer.writerow(['TOTAL:', f"{total_consumption:.2f}", total_cycles, ''])
-            writer.writerow([])
-            writer.writerow(['End of Report'])
-        
-        elif data_type == 'sensor':
-            # Header Section
-            writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'])
-            writer.writerow(['SENSOR READINGS REPORT'])
-            writer.writerow([])
-            writer.writerow(['Report Details'])
-            writer.writerow(['Account Holder:', user_name])
-            writer.writerow(['Device Name:', device_name])
-            writer.writerow(['Account ID:', account_id])
-            writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-            writer.writerow(['Generated:', report_date])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Summary
-            writer.writerow(['SUMMARY'])
-            writer.writerow(['Total Sensor Readings:', len(usage_data['sensor_logs'])])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Data Table
-            writer.writerow(['SENSOR READINGS LOG'])
-            writer.writerow([])
-            writer.writerow(['Date & Time', 'Sensor ID', 'Reading Value', 'Unit', 'Status'])
-            writer.writerow(['-' * 20, '-' * 15, '-' * 15, '-' * 10, '-' * 15])
-            
-            for row in usage_data['sensor_logs']:
-                status = 'Normal'
-                reading = row['reading_value']
-                if reading > 10:
-                    status = 'High Flow'
-                elif reading == 0:
-                    status = 'No Flow'
+                # Data Table
+                yield writer.writerow(['DAILY CONSUMPTION DETAILS'])
+                yield writer.writerow([])
+                yield writer.writerow(['Date', 'Water Consumed (L)', 'Pump Cycles', 'Notes'])
+                yield writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 30])
                 
-                writer.writerow([
-                    row['timestamp'][:19], 
-                    row['sensor_id'], 
-                    f"{reading:.2f}",
-                    row['unit'],
-                    status
-                ])
-            
-            writer.writerow([])
-            writer.writerow(['End of Report'])
-        
-        elif data_type == 'power':
-            # Header Section
-            writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'])
-            writer.writerow(['POWER & BATTERY REPORT'])
-            writer.writerow([])
-            writer.writerow(['Report Details'])
-            writer.writerow(['Account Holder:', user_name])
-            writer.writerow(['Device Name:', device_name])
-            writer.writerow(['Account ID:', account_id])
-            writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-            writer.writerow(['Generated:', report_date])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Summary
-            summary = usage_data['summary']
-            writer.writerow(['SUMMARY'])
-            writer.writerow(['Total Power Readings:', len(usage_data['power_logs'])])
-            writer.writerow(['Average Battery Level:', f"{summary['avg_battery_percent']:.1f}%"])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Data Table
-            writer.writerow(['POWER MONITORING LOG'])
-            writer.writerow([])
-            writer.writerow(['Date & Time', 'Voltage (V)', 'Current (A)', 'Battery (%)', 'Battery Status'])
-            writer.writerow(['-' * 20, '-' * 12, '-' * 12, '-' * 12, '-' * 15])
-            
-            for row in usage_data['power_logs']:
-                battery = row['battery_percent']
-                if battery > 75:
-                    status = 'Good'
-                elif battery > 50:
-                    status = 'Fair'
-                elif battery > 25:
-                    status = 'Low'
-                else:
-                    status = 'Critical'
+                total_consumption = 0
+                total_cycles = 0
                 
-                writer.writerow([
-                    row['timestamp'][:19], 
-                    f"{row['voltage']:.2f}",
-                    f"{row['current']:.2f}",
-                    f"{battery:.0f}%",
-                    status
-                ])
-            
-            writer.writerow([])
-            writer.writerow(['End of Report'])
-        
-        elif data_type == 'control':
-            # Header Section
-            writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'])
-            writer.writerow(['PUMP CONTROL LOG REPORT'])
-            writer.writerow([])
-            writer.writerow(['Report Details'])
-            writer.writerow(['Account Holder:', user_name])
-            writer.writerow(['Device Name:', device_name])
-            writer.writerow(['Account ID:', account_id])
-            writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-            writer.writerow(['Generated:', report_date])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Summary
-            writer.writerow(['SUMMARY'])
-            writer.writerow(['Total Control Actions:', len(usage_data['control_logs'])])
-            
-            # Count actions
-            manual_count = sum(1 for log in usage_data['control_logs'] if log['method'] == 'Manual')
-            remote_count = sum(1 for log in usage_data['control_logs'] if log['method'] == 'Remote')
-            
-            writer.writerow(['Manual Actions:', manual_count])
-            writer.writerow(['Remote Actions:', remote_count])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Data Table
-            writer.writerow(['CONTROL ACTIONS LOG'])
-            writer.writerow([])
-            writer.writerow(['Date & Time', 'Action', 'Method', 'Details'])
-            writer.writerow(['-' * 20, '-' * 15, '-' * 12, '-' * 35])
-            
-            for row in usage_data['control_logs']:
-                writer.writerow([
-                    row['timestamp'][:19], 
-                    row['action'], 
-                    row['method'], 
-                    row['details']
-                ])
-            
-            writer.writerow([])
-            writer.writerow(['End of Report'])
-        
-        elif data_type == 'alerts':
-            # Header Section
-            writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'])
-            writer.writerow(['SYSTEM ALERTS REPORT'])
-            writer.writerow([])
-            writer.writerow(['Report Details'])
-            writer.writerow(['Account Holder:', user_name])
-            writer.writerow(['Device Name:', device_name])
-            writer.writerow(['Account ID:', account_id])
-            writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-            writer.writerow(['Generated:', report_date])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Summary
-            summary = usage_data['summary']
-            writer.writerow(['SUMMARY'])
-            writer.writerow(['Total Alerts:', summary['total_alerts']])
-            
-            # Count by type
-            alert_types = {}
-            for alert in usage_data['alerts']:
-                alert_type = alert['alert_type']
-                alert_types[alert_type] = alert_types.get(alert_type, 0) + 1
-            
-            for alert_type, count in alert_types.items():
-                writer.writerow([f'{alert_type} Alerts:', count])
-            
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-            
-            # Data Table
-            writer.writerow(['ALERTS LOG'])
-            writer.writerow([])
-            writer.writerow(['Date & Time', 'Alert Type', 'Status', 'Details', 'Priority'])
-            writer.writerow(['-' * 20, '-' * 15, '-' * 12, '-' * 30, '-' * 10])
-            
-            for row in usage_data['alerts']:
-                # Determine priority
-                priority = 'High' if row['alert_type'] == 'Leakage' else 'Medium'
-                if 'Battery' in row['alert_type']:
-                    priority = 'Low'
+                for row in usage_data['consumption']:
+                    notes = ''
+                    if row['consumption_total'] > summary['avg_daily_consumption'] * 1.5:
+                        notes = 'Above average usage'
+                    elif row['consumption_total'] == 0:
+                        notes = 'No usage recorded'
+                    
+                    yield writer.writerow([
+                        row['date'], 
+                        f"{row['consumption_total']:.2f}", 
+                        row['pump_cycles'],
+                        notes
+                    ])
+                    total_consumption += row['consumption_total']
+                    total_cycles += row['pump_cycles']
                 
-                writer.writerow([
-                    row['timestamp'][:19], 
-                    row['alert_type'], 
-                    row['status'], 
-                    row['details'],
-                    priority
-                ])
-            
-            writer.writerow([])
-            writer.writerow(['End of Report'])
-        
-        elif data_type == 'summary':
-            # Header Section
-            writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'])
-            writer.writerow(['EXECUTIVE SUMMARY REPORT'])
-            writer.writerow([])
-            writer.writerow(['Report Details'])
-            writer.writerow(['Account Holder:', user_name])
-            writer.writerow(['Device Name:', device_name])
-            writer.writerow(['Account ID:', account_id])
-            writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-            writer.writerow(['Generated:', report_date])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
+                yield writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 30])
+                yield writer.writerow(['TOTAL:', f"{total_consumption:.2f}", total_cycles, ''])
+                yield writer.writerow([])
+                yield writer.writerow(['End of Report'])
             
-            summary = usage_data['summary']
-            
-            # Key Metrics
-            writer.writerow(['KEY PERFORMANCE INDICATORS'])
-            writer.writerow([])
-            writer.writerow(['Metric', 'Value', 'Unit'])
-            writer.writerow(['-' * 35, '-' * 15, '-' * 10])
-            writer.writerow(['Reporting Period Duration', summary['total_days'], 'days'])
-            writer.writerow(['Total Water Consumption', f"{summary['total_consumption']:.2f}", 'liters'])
-            writer.writerow(['Average Daily Consumption', f"{summary['avg_daily_consumption']:.2f}", 'liters/day'])
-            writer.writerow(['Total Pump Operations', summary['total_pump_cycles'], 'cycles'])
-            writer.writerow(['Average Battery Level', f"{summary['avg_battery_percent']:.1f}", '%'])
-            writer.writerow(['Total System Alerts', summary['total_alerts'], 'alerts'])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
+            elif data_type == 'sensor':
+                # Summary
+                yield writer.writerow(['SUMMARY'])
+                yield writer.writerow(['Total Sensor Readings:', usage_data['summary']['total_sensor_logs']])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
+                
+                # Data Table
+                yield writer.writerow(['SENSOR READINGS LOG'])
+                yield writer.writerow([])
+                yield writer.writerow(['Date & Time', 'Sensor ID', 'Reading Value', 'Unit', 'Status'])
+                yield writer.writerow(['-' * 20, '-' * 15, '-' * 15, '-' * 10, '-' * 15])
+                
+                for row in usage_data['sensor_logs']:
+                    status = 'Normal'
+                    reading = row['reading_value']
+                    if reading > 10:
+                        status = 'High Flow'
+                    elif reading == 0:
+                        status = 'No Flow'
+                    
+                    yield writer.writerow([
+                        row['timestamp'][:19], 
+                        row['sensor_id'], 
+                        f"{reading:.2f}",
+                        row['unit'],
+                        status
+                    ])
+                
+                yield writer.writerow([])
+                yield writer.writerow(['End of Report'])
             
-            # Activity Summary
-            writer.writerow(['SYSTEM ACTIVITY SUMMARY'])
-            writer.writerow([])
-            writer.writerow(['Activity Type', 'Count'])
-            writer.writerow(['-' * 35, '-' * 15])
-            writer.writerow(['Sensor Readings Recorded', summary['total_sensor_logs']])
-            writer.writerow(['Power Status Checks', summary['total_power_logs']])
-            writer.writerow(['Control Actions Performed', summary['total_control_logs']])
-            writer.writerow(['Alerts Generated', summary['total_alerts']])
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
+            elif data_type == 'power':
+                # Summary
+                summary = usage_data['summary']
+                yield writer.writerow(['SUMMARY'])
+                yield writer.writerow(['Total Power Readings:', summary['total_power_logs']])
+                yield writer.writerow(['Average Battery Level:', f"{summary['avg_battery_percent']:.1f}%"])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
+                
+                # Data Table
+                yield writer.writerow(['POWER MONITORING LOG'])
+                yield writer.writerow([])
+                yield writer.writerow(['Date & Time', 'Voltage (V)', 'Current (A)', 'Battery (%)', 'Battery Status'])
+                yield writer.writerow(['-' * 20, '-' * 12, '-' * 12, '-' * 12, '-' * 15])
+                
+                for row in usage_data['power_logs']:
+                    battery = row['battery_percent']
+                    if battery > 75:
+                        status = 'Good'
+                    elif battery > 50:
+                        status = 'Fair'
+                    elif battery > 25:
+                        status = 'Low'
+                    else:
+                        status = 'Critical'
+                    
+                    yield writer.writerow([
+                        row['timestamp'][:19], 
+                        f"{row['voltage']:.2f}",
+                        f"{row['current']:.2f}",
+                        f"{battery:.0f}%",
+                        status
+                    ])
+                
+                yield writer.writerow([])
+                yield writer.writerow(['End of Report'])
             
-            # System Health
-            writer.writerow(['SYSTEM HEALTH INDICATORS'])
-            writer.writerow([])
+            elif data_type == 'control':
+                # Summary
+                yield writer.writerow(['SUMMARY'])
+                yield writer.writerow(['Total Control Actions:', usage_data['summary']['total_control_logs']])
+                
+                # Count actions (over the most recent actions listed below)
+                manual_count = sum(1 for log in usage_data['control_logs'] if log['method'] == 'Manual')
+                remote_count = sum(1 for log in usage_data['control_logs'] if log['method'] == 'Remote')
+                
+                yield writer.writerow(['Manual Actions:', manual_count])
+                yield writer.writerow(['Remote Actions:', remote_count])
+                if usage_data['summary']['total_control_logs'] > len(usage_data['control_logs']):
+                    yield writer.writerow([f"Note: Manual/Remote counts cover the last {len(usage_data['control_logs'])} actions"])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
+                
+                # Data Table
+                yield writer.writerow(['CONTROL ACTIONS LOG'])
+                yield writer.writerow([])
+                yield writer.writerow(['Date & Time', 'Action', 'Method', 'Details'])
+                yield writer.writerow(['-' * 20, '-' * 15, '-' * 12, '-' * 35])
+                
+                for row in usage_data['control_logs']:
+                    yield writer.writerow([
+                        row['timestamp'][:19], 
+                        row['action'], 
+                        row['method'], 
+                        row['details']
+                    ])
+                
+                yield writer.writerow([])
+                yield writer.writerow(['End of Report'])
             
-            health_status = 'Excellent'
-            if summary['total_alerts'] > 5:
-                health_status = 'Needs Attention'
-            elif summary['total_alerts'] > 2:
-                health_status = 'Good'
+            elif data_type == 'alerts':
+                # Summary
+                summary = usage_data['summary']
+                yield writer.writerow(['SUMMARY'])
+                yield writer.writerow(['Total Alerts:', summary['total_alerts']])
+                
+                # Count by type
+                alert_types = {}
+                for alert in usage_data['alerts']:
+                    alert_type = alert['alert_type']
+                    alert_types[alert_type] = alert_types.get(alert_type, 0) + 1
+                
+                for alert_type, count in alert_types.items():
+                    yield writer.writerow([f'{alert_type} Alerts:', count])
+                
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
+                
+                # Data Table
+                yield writer.writerow(['ALERTS LOG'])
+                yield writer.writerow([])
+                yield writer.writerow(['Date & Time', 'Alert Type', 'Status', 'Details', 'Priority'])
+                yield writer.writerow(['-' * 20, '-' * 15, '-' * 12, '-' * 30, '-' * 10])
+                
+                for row in usage_data['alerts']:
+                    # Determine priority
+                    priority = 'High' if row['alert_type'] == 'Leakage' else 'Medium'
+                    if 'Battery' in row['alert_type']:
+                        priority = 'Low'
+                    
+                    yield writer.writerow([
+                        row['timestamp'][:19], 
+                        row['alert_type'], 
+                        row['status'], 
+                        row['details'],
+                        priority
+                    ])
+                
+                yield writer.writerow([])
+                yield writer.writerow(['End of Report'])
             
-            writer.writerow(['Overall System Status:', health_status])
-            writer.writerow(['Average Battery Health:', f"{summary['avg_battery_percent']:.1f}%"])
-            writer.writerow(['Pump Efficiency:', 'Normal' if summary['total_pump_cycles'] > 0 else 'Check Required'])
-            writer.writerow([])
-            writer.writerow(['End of Report'])
-        
-        else:
-            return jsonify({"error": "Invalid data type"}), 400
-        
-        output.seek(0)
+            elif data_type == 'summary':
+                summary = usage_data['summary']
+                
+                # Key Metrics
+                yield writer.writerow(['KEY PERFORMANCE INDICATORS'])
+                yield writer.writerow([])
+                yield writer.writerow(['Metric', 'Value', 'Unit'])
+                yield writer.writerow(['-' * 35, '-' * 15, '-' * 10])
+                yield writer.writerow(['Reporting Period Duration', summary['total_days'], 'days'])
+                yield writer.writerow(['Total Water Consumption', f"{summary['total_consumption']:.2f}", 'liters'])
+                yield writer.writerow(['Average Daily Consumption', f"{summary['avg_daily_consumption']:.2f}", 'liters/day'])
+                yield writer.writerow(['Total Pump Operations', summary['total_pump_cycles'], 'cycles'])
+                yield writer.writerow(['Average Battery Level', f"{summary['avg_battery_percent']:.1f}", '%'])
+                yield writer.writerow(['Total System Alerts', summary['total_alerts'], 'alerts'])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
+                
+                # Activity Summary
+                yield writer.writerow(['SYSTEM ACTIVITY SUMMARY'])
+                yield writer.writerow([])
+                yield writer.writerow(['Activity Type', 'Count'])
+                yield writer.writerow(['-' * 35, '-' * 15])
+                yield writer.writerow(['Sensor Readings Recorded', summary['total_sensor_logs']])
+                yield writer.writerow(['Power Status Checks', summary['total_power_logs']])
+                yield writer.writerow(['Control Actions Performed', summary['total_control_logs']])
+                yield writer.writerow(['Alerts Generated', summary['total_alerts']])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
+                
+                # System Health
+                yield writer.writerow(['SYSTEM HEALTH INDICATORS'])
+                yield writer.writerow([])
+                
+                health_status = 'Excellent'
+                if summary['total_alerts'] > 5:
+                    health_status = 'Needs Attention'
+                elif summary['total_alerts'] > 2:
+                    health_status = 'Good'
+                
+                yield writer.writerow(['Overall System Status:', health_status])
+                yield writer.writerow(['Average Battery Health:', f"{summary['avg_battery_percent']:.1f}%"])
+                yield writer.writerow(['Pump Efficiency:', 'Normal' if summary['total_pump_cycles'] > 0 else 'Check Required'])
+                yield writer.writerow([])
+                yield writer.writerow(['End of Report'])
         
         filename = f"AquaSolar_{data_type.upper()}_{start_date}_to_{end_date}.csv"
         
         return Response(
-            output.getvalue(),
+            stream_with_context(generate()),
             mimetype='text/csv',
             headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
         
     except Exception as e:
-        print(f"Error generating CSV: {e}")
+        logger.error(f"Error generating CSV: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/download-report", methods=["GET"])
@@ -1049,9 +1698,9 @@ def download_report():
         
         # Default dates
         if not end_date:
-            end_date = datetime.now().date().isoformat()
+            end_date = g.today_iso
         if not start_date:
-            start_date = (datetime.now().date() - timedelta(days=30)).isoformat()
+            start_date = get_today()['month_ago_iso']
         
         usage_data = get_usage_data_by_date_range(start_date, end_date)
         
@@ -1063,301 +1712,376 @@ def download_report():
         device_name = session.get('device_name', 'AquaSolar')
         account_id = session.get('account_id', 'N/A')
         
-        # Create comprehensive CSV report
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
         # Generate report timestamp
         report_date = datetime.now().strftime('%B %d, %Y at %I:%M %p')
         
-        # Header Section
-        writer.writerow(['=' * 80])
-        writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'.center(80)])
-        writer.writerow(['COMPREHENSIVE USAGE REPORT'.center(80)])
-        writer.writerow(['=' * 80])
-        writer.writerow([])
-        
-        writer.writerow(['REPORT INFORMATION'])
-        writer.writerow(['-' * 80])
-        writer.writerow(['Account Holder:', user_name])
-        writer.writerow(['Device Name:', device_name])
-        writer.writerow(['Account ID:', account_id])
-        writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
-        writer.writerow(['Report Generated:', report_date])
-        writer.writerow([])
-        writer.writerow(['=' * 80])
-        writer.writerow([])
-        
-        summary = usage_data['summary']
-        
-        # Executive Summary
-        writer.writerow(['EXECUTIVE SUMMARY'])
-        writer.writerow(['-' * 80])
-        writer.writerow([])
-        writer.writerow(['Metric', 'Value', 'Unit'])
-        writer.writerow(['-' * 35, '-' * 15, '-' * 10])
-        writer.writerow(['Reporting Period', summary['total_days'], 'days'])
-        writer.writerow(['Total Water Consumption', f"{summary['total_consumption']:.2f}", 'liters'])
-        writer.writerow(['Average Daily Consumption', f"{summary['avg_daily_consumption']:.2f}", 'liters/day'])
-        writer.writerow(['Total Pump Cycles', summary['total_pump_cycles'], 'cycles'])
-        writer.writerow(['Average Battery Level', f"{summary['avg_battery_percent']:.1f}", '%'])
-        writer.writerow(['Total System Alerts', summary['total_alerts'], 'alerts'])
-        writer.writerow([])
-        writer.writerow(['=' * 80])
-        writer.writerow([])
-        
-        # Daily Consumption Section
-        writer.writerow(['SECTION 1: DAILY WATER CONSUMPTION'])
-        writer.writerow(['-' * 80])
-        writer.writerow([])
-        writer.writerow(['Date', 'Consumption (L)', 'Pump Cycles', 'Status'])
-        writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 25])
-        
-        for row in usage_data['consumption']:
-            status = 'Normal'
-            if row['consumption_total'] > summary['avg_daily_consumption'] * 1.5:
-                status = 'Above Average'
-            elif row['consumption_total'] == 0:
-                status = 'No Usage'
+        def generate():
+            # Every writerow hands back its formatted line, which goes out as soon as it is built
+            writer = csv.writer(CSVLineEcho())
+            
+            # Header Section
+            yield writer.writerow(['=' * 80])
+            yield writer.writerow(['AQUASOLAR WATER MONITORING SYSTEM'.center(80)])
+            yield writer.writerow(['COMPREHENSIVE USAGE REPORT'.center(80)])
+            yield writer.writerow(['=' * 80])
+            yield writer.writerow([])
             
-            writer.writerow([
-                row['date'], 
-                f"{row['consumption_total']:.2f}", 
-                row['pump_cycles'],
-                status
-            ])
-        
-        writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 25])
-        writer.writerow(['TOTAL', f"{summary['total_consumption']:.2f}", summary['total_pump_cycles'], ''])
-        writer.writerow([])
-        writer.writerow(['=' * 80])
-        writer.writerow([])
-        
-        # Alerts Section
-        if usage_data['alerts']:
-            writer.writerow(['SECTION 2: SYSTEM ALERTS & NOTIFICATIONS'])
-            writer.writerow(['-' * 80])
-            writer.writerow([])
-            writer.writerow(['Date & Time', 'Type', 'Priority', 'Status', 'Details'])
-            writer.writerow(['-' * 20, '-' * 15, '-' * 10, '-' * 12, '-' * 30])
+            yield writer.writerow(['REPORT INFORMATION'])
+            yield writer.writerow(['-' * 80])
+            yield writer.writerow(['Account Holder:', user_name])
+            yield writer.writerow(['Device Name:', device_name])
+            yield writer.writerow(['Account ID:', account_id])
+            yield writer.writerow(['Report Period:', f"{start_date} to {end_date}"])
+            yield writer.writerow(['Report Generated:', report_date])
+            yield writer.writerow([])
+            yield writer.writerow(['=' * 80])
+            yield writer.writerow([])
+            
+            summary = usage_data['summary']
             
-            for row in usage_data['alerts']:
-                priority = 'HIGH' if row['alert_type'] == 'Leakage' else 'MEDIUM'
-                if 'Battery' in row['alert_type']:
-                    priority = 'LOW'
+            # Executive Summary
+            yield writer.writerow(['EXECUTIVE SUMMARY'])
+            yield writer.writerow(['-' * 80])
+            yield writer.writerow([])
+            yield writer.writerow(['Metric', 'Value', 'Unit'])
+            yield writer.writerow(['-' * 35, '-' * 15, '-' * 10])
+            yield writer.writerow(['Reporting Period', summary['total_days'], 'days'])
+            yield writer.writerow(['Total Water Consumption', f"{summary['total_consumption']:.2f}", 'liters'])
+            yield writer.writerow(['Average Daily Consumption', f"{summary['avg_daily_consumption']:.2f}", 'liters/day'])
+            yield writer.writerow(['Total Pump Cycles', summary['total_pump_cycles'], 'cycles'])
+            yield writer.writerow(['Average Battery Level', f"{summary['avg_battery_percent']:.1f}", '%'])
+            yield writer.writerow(['Total System Alerts', summary['total_alerts'], 'alerts'])
+            yield writer.writerow([])
+            yield writer.writerow(['=' * 80])
+            yield writer.writerow([])
+            
+            # Daily Consumption Section
+            yield writer.writerow(['SECTION 1: DAILY WATER CONSUMPTION'])
+            yield writer.writerow(['-' * 80])
+            yield writer.writerow([])
+            yield writer.writerow(['Date', 'Consumption (L)', 'Pump Cycles', 'Status'])
+            yield writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 25])
+            
+            above_average = summary['avg_daily_consumption'] * 1.5
+            yield csv_rows_chunk(
+                (row['date'],
+                 f"{row['consumption_total']:.2f}",
+                 row['pump_cycles'],
+                 'Above Average' if row['consumption_total'] > above_average
+                 else 'No Usage' if row['consumption_total'] == 0 else 'Normal')
+                for row in usage_data['consumption']
+            )
+            
+            yield writer.writerow(['-' * 15, '-' * 18, '-' * 12, '-' * 25])
+            yield writer.writerow(['TOTAL', f"{summary['total_consumption']:.2f}", summary['total_pump_cycles'], ''])
+            yield writer.writerow([])
+            yield writer.writerow(['=' * 80])
+            yield writer.writerow([])
+            
+            # Alerts Section
+            if usage_data['alerts']:
+                yield writer.writerow(['SECTION 2: SYSTEM ALERTS & NOTIFICATIONS'])
+                yield writer.writerow(['-' * 80])
+                yield writer.writerow([])
+                yield writer.writerow(['Date & Time', 'Type', 'Priority', 'Status', 'Details'])
+                yield writer.writerow(['-' * 20, '-' * 15, '-' * 10, '-' * 12, '-' * 30])
+                
+                yield csv_rows_chunk(
+                    (row['timestamp'][:19],
+                     row['alert_type'],
+                     'LOW' if 'Battery' in row['alert_type']
+                     else 'HIGH' if row['alert_type'] == 'Leakage' else 'MEDIUM',
+                     row['status'],
+                     row['details'])
+                    for row in usage_data['alerts']
+                )
                 
-                writer.writerow([
-                    row['timestamp'][:19], 
-                    row['alert_type'], 
-                    priority,
-                    row['status'], 
-                    row['details']
-                ])
+                yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
             
-            writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-        
-        # Control Logs Section
-        if usage_data['control_logs']:
-            writer.writerow(['SECTION 3: PUMP CONTROL HISTORY'])
-            writer.writerow(['-' * 80])
-            writer.writerow([])
-            writer.writerow(['Date & Time', 'Action', 'Method', 'Details'])
-            writer.writerow(['-' * 20, '-' * 15, '-' * 12, '-' * 35])
+            # Control Logs Section
+            if usage_data['control_logs']:
+                yield writer.writerow(['SECTION 3: PUMP CONTROL HISTORY'])
+                yield writer.writerow(['-' * 80])
+                yield writer.writerow([])
+                yield writer.writerow(['Date & Time', 'Action', 'Method', 'Details'])
+                yield writer.writerow(['-' * 20, '-' * 15, '-' * 12, '-' * 35])
+                
+                yield csv_rows_chunk(
+                    (row['timestamp'][:19], row['action'], row['method'], row['details'])
+                    for row in usage_data['control_logs'][-20:]  # Last 20 actions (rows are oldest first)
+                )
+                
+                yield writer.writerow([])
+                if summary['total_control_logs'] > 20:
+                    yield writer.writerow([f"Note: Showing last 20 of {summary['total_control_logs']} total control actions"])
+                    yield writer.writerow([])
+                yield writer.writerow(['=' * 80])
+                yield writer.writerow([])
             
-            for row in usage_data['control_logs'][:20]:  # Last 20 actions
-                writer.writerow([
-                    row['timestamp'][:19], 
-                    row['action'], 
-                    row['method'], 
-                    row['details']
-                ])
+            # System Health
+            yield writer.writerow(['SECTION 4: SYSTEM HEALTH ASSESSMENT'])
+            yield writer.writerow(['-' * 80])
+            yield writer.writerow([])
             
-            writer.writerow([])
-            if len(usage_data['control_logs']) > 20:
-                writer.writerow([f'Note: Showing last 20 of {len(usage_data["control_logs"])} total control actions'])
-                writer.writerow([])
-            writer.writerow(['=' * 80])
-            writer.writerow([])
-        
-        # System Health
-        writer.writerow(['SECTION 4: SYSTEM HEALTH ASSESSMENT'])
-        writer.writerow(['-' * 80])
-        writer.writerow([])
-        
-        health_status = 'EXCELLENT'
-        if summary['total_alerts'] > 5:
-            health_status = 'NEEDS ATTENTION'
-        elif summary['total_alerts'] > 2:
-            health_status = 'GOOD'
-        
-        writer.writerow(['Overall System Status:', health_status])
-        writer.writerow(['Battery Health:', f"{summary['avg_battery_percent']:.1f}% - {'Good' if summary['avg_battery_percent'] > 50 else 'Fair'}"])
-        writer.writerow(['Pump Operations:', f"{summary['total_pump_cycles']} cycles - {'Normal' if summary['total_pump_cycles'] > 0 else 'Check Required'}"])
-        writer.writerow(['Monitoring Activity:', f"{summary['total_sensor_logs']} sensor readings recorded"])
-        writer.writerow([])
-        writer.writerow(['=' * 80])
-        writer.writerow([])
-        
-        # Footer
-        writer.writerow(['END OF REPORT'])
-        writer.writerow(['-' * 80])
-        writer.writerow([f'Report generated by AquaSolar Water Monitoring System on {report_date}'])
-        writer.writerow(['For questions or support, please contact your system administrator.'])
-        
-        output.seek(0)
+            health_status = 'EXCELLENT'
+            if summary['total_alerts'] > 5:
+                health_status = 'NEEDS ATTENTION'
+            elif summary['total_alerts'] > 2:
+                health_status = 'GOOD'
+            
+            yield writer.writerow(['Overall System Status:', health_status])
+            yield writer.writerow(['Battery Health:', f"{summary['avg_battery_percent']:.1f}% - {'Good' if summary['avg_battery_percent'] > 50 else 'Fair'}"])
+            yield writer.writerow(['Pump Operations:', f"{summary['total_pump_cycles']} cycles - {'Normal' if summary['total_pump_cycles'] > 0 else 'Check Required'}"])
+            yield writer.writerow(['Monitoring Activity:', f"{summary['total_sensor_logs']} sensor readings recorded"])
+            yield writer.writerow([])
+            yield writer.writerow(['=' * 80])
+            yield writer.writerow([])
+            
+            # Footer
+            yield writer.writerow(['END OF REPORT'])
+            yield writer.writerow(['-' * 80])
+            yield writer.writerow([f'Report generated by AquaSolar Water Monitoring System on {report_date}'])
+            yield writer.writerow(['For questions or support, please contact your system administrator.'])
         
         filename = f"AquaSolar_FULL_REPORT_{start_date}_to_{end_date}.csv"
         
         return Response(
-            output.getvalue(),
+            stream_with_context(generate()),
             mimetype='text/csv',
             headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
         
     except Exception as e:
-        print(f"Error generating report: {e}")
+        logger.error(f"Error generating report: {e}")
         return jsonify({"error": str(e)}), 500
 
 # ------------------------------- 
 # 🔹 ESP32 Communication Endpoints (OPTIMIZED)
 # ------------------------------- 
+# Telemetry fields the status handler does arithmetic on
+ESP32_NUMERIC_FIELDS = (
+    'flow_in_L_min', 'flow_out_L_min', 'volume_in_L', 'volume_out_L',
+    'battery_percent', 'battery_voltage_V', 'current_A'
+)
+
+MAX_SAMPLES_PER_POST = 120       # readings buffered by the ESP32 between posts
+
+def validate_esp32_status(data):
+    """Return an error message if an ESP32 status payload is malformed, else None"""
+    if not isinstance(data, dict):
+        return "JSON object body is required"
+    if 'account_id' in data and not is_valid_account_id(data['account_id']):
+        return "account_id must be a string of letters, digits, '_' or '-'"
+    for field in ESP32_NUMERIC_FIELDS:
+        if field not in data:
+            continue
+        # An explicit null is rejected too: these fields feed comparisons and Increment()
+        value = data[field]
+        if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+            return f"{field} must be a number"
+    
+    samples = data.get('samples')
+    if samples is not None:
+        if not isinstance(samples, list) or not 0 < len(samples) <= MAX_SAMPLES_PER_POST:
+            return f"samples must be a list of 1 to {MAX_SAMPLES_PER_POST} readings"
+        for sample in samples:
+            if not isinstance(sample, dict) or 'samples' in sample:
+                return "each sample must be a JSON object"
+            error = validate_esp32_status(sample)
+            if error:
+                return error
+    return None
+
+# Throttled telemetry logs: each is written when its interval has passed OR its
+# watched value moved by at least the threshold since the last logged reading
+LOG_RULES = (
+    {
+        'label': "📊 Sensor",
+        'fields': ('flow_in_L_min',),
+        'interval': SENSOR_LOG_INTERVAL,
+        'last_time_key': 'last_sensor_log_time',
+        'watch': 'flow_in_L_min',
+        'threshold': FLOW_CHANGE_THRESHOLD,
+        'change_reason': "Significant flow change",
+        'write': lambda sample, **kwargs: add_sensor_log("SENS_FLOW_IN", sample['flow_in_L_min'], **kwargs)
+    },
+    {
+        'label': "🔋 Power",
+        'fields': ('battery_voltage_V', 'current_A', 'battery_percent'),
+        'interval': POWER_LOG_INTERVAL,
+        'last_time_key': 'last_power_log_time',
+        'watch': 'battery_percent',
+        'threshold': BATTERY_CHANGE_THRESHOLD,
+        'change_reason': "Significant battery change",
+        'write': lambda sample, **kwargs: add_power_log(
+            sample['battery_voltage_V'], sample['current_A'], sample['battery_percent'], **kwargs
+        )
+    }
+)
+
+def log_esp32_sample(sample, cache, account_id, batch, current_time):
+    """Stage the sensor/power logs and alerts one ESP32 reading calls for"""
+    # When the reading was taken, per the ESP32's NTP clock (optional)
+    reading_time = get_log_timestamp(sample.get('ts_client'))
+    last_logged_values = cache['last_logged_values']
+    
+    for rule in LOG_RULES:
+        if not all(field in sample for field in rule['fields']):
+            continue
+        
+        watch = rule['watch']
+        if current_time - cache[rule['last_time_key']] >= rule['interval']:
+            reason = f"Time interval ({rule['interval']}s)"
+        elif is_significant_change(sample[watch], last_logged_values.get(watch), rule['threshold']):
+            reason = rule['change_reason']
+        else:
+            continue
+        
+        rule['write'](sample, account_id=account_id, batch=batch, timestamp=reading_time)
+        cache[rule['last_time_key']] = current_time
+        last_logged_values[watch] = sample[watch]
+        logger.info(f"{rule['label']} logged for {account_id}: {reason}")
+    
+    # 🚨 Alert while a condition holds, throttled by a per-type cooldown so a flapping
+    # sensor can't flood alerts and a persistent fault keeps being surfaced
+    alert_bits = (LEAKAGE_BIT if sample.get('leakage_detected', False) else 0) | \
+                 (LOW_BATTERY_BIT if sample.get('battery_percent', 100) <= LOW_BATTERY_PERCENT else 0)
+    
+    if alert_bits & LEAKAGE_BIT and is_alert_due(cache, LEAKAGE_BIT, current_time):
+        add_alert("Leakage", "Flow differential exceeded threshold", account_id=account_id, batch=batch)
+    
+    if alert_bits & LOW_BATTERY_BIT and is_alert_due(cache, LOW_BATTERY_BIT, current_time):
+        add_alert("Low Battery", f"Battery at {sample.get('battery_percent')}%", account_id=account_id, batch=batch)
+
 @app.route("/api/esp32/status", methods=["POST"])
 def esp32_status_update():
     """
     Optimized endpoint for ESP32 to push status updates
     Uses smart throttling and change detection to reduce Firebase writes by ~95%
+    All writes for one update are queued together and committed in the background
     
     ESP32 should send account_id in the request body or as a query parameter
     """
     try:
-        data = request.get_json()
+        # Reject malformed bodies up front instead of failing halfway through the update
+        data = request.get_json(silent=True)
+        error = validate_esp32_status(data)
+        if error:
+            return jsonify({"error": error}), 400
         
         # Get account_id from request (ESP32 must provide this)
         account_id = data.get('account_id') or request.args.get('account_id')
         
         if not account_id:
             return jsonify({"error": "account_id is required"}), 400
+        if not is_valid_account_id(account_id):
+            return jsonify({"error": "Invalid account_id"}), 400
         
         # Get cache for this specific account
         cache = get_account_cache(account_id)
+        if cache is None:
+            return jsonify({"error": "Unknown account_id"}), 404
         current_time = time.time()
         
-        # ✅ ALWAYS update real-time status (this is what dashboard reads)
-        update_realtime_status(data, account_id)
-        
-        # 📊 Log sensor readings ONLY every 5 minutes OR on significant change
-        if 'flow_in_L_min' in data:
-            should_log_sensor = False
-            
-            # Check if enough time has passed
-            if current_time - cache['last_sensor_log_time'] >= SENSOR_LOG_INTERVAL:
-                should_log_sensor = True
-                reason = f"Time interval ({SENSOR_LOG_INTERVAL}s)"
-            
-            # OR check if flow changed significantly
-            elif is_significant_change(
-                data['flow_in_L_min'], 
-                cache['last_logged_values'].get('flow_in_L_min'),
-                FLOW_CHANGE_THRESHOLD
-            ):
-                should_log_sensor = True
-                reason = "Significant flow change"
-            
-            if should_log_sensor:
-                add_sensor_log("SENS_FLOW_IN", data['flow_in_L_min'], account_id=account_id)
-                cache['last_sensor_log_time'] = current_time
-                cache['last_logged_values']['flow_in_L_min'] = data['flow_in_L_min']
-                print(f"📊 Sensor logged for {account_id}: {reason}")
-        
-        # 🔋 Log power status ONLY every 10 minutes OR on significant change
-        if all(k in data for k in ['battery_voltage_V', 'current_A', 'battery_percent']):
-            should_log_power = False
-            
-            # Check if enough time has passed
-            if current_time - cache['last_power_log_time'] >= POWER_LOG_INTERVAL:
-                should_log_power = True
-                reason = f"Time interval ({POWER_LOG_INTERVAL}s)"
-            
-            # OR check if battery dropped significantly
-            elif is_significant_change(
-                data['battery_percent'],
-                cache['last_logged_values'].get('battery_percent'),
-                BATTERY_CHANGE_THRESHOLD
-            ):
-                should_log_power = True
-                reason = "Significant battery change"
+        # Record every write so the whole update is committed together
+        batch = PendingWrites()
+        
+        # Buffering firmware may post several readings at once (oldest first);
+        # the newest one becomes the live status
+        samples = data.pop('samples', None) or [dict(data)]
+        data.update(samples[-1])
+        data.pop('ts_client', None)
+        
+        # Throttling state is read and updated together; concurrent posts for the
+        # same account (threaded workers) take turns so nothing is logged twice
+        with cache['lock']:
+            # Throttle timers, logged values, alert cooldowns and the status hash only
+            # count once the writes they stand for are queued; otherwise they roll back
+            throttle_state = snapshot_throttle_state(cache)
+            try:
+                # ✅ ALWAYS update real-time status (this is what dashboard reads), but only
+                # write it to Firestore when the payload changed or the last write is getting old
+                # Floats are rounded first so sensor jitter alone doesn't count as a change
+                status_hash = hashlib.blake2b(orjson.dumps(
+                    {k: round(v, 2) if isinstance(v, float) else v for k, v in data.items()},
+                    default=str, option=orjson.OPT_SORT_KEYS
+                ), digest_size=8).digest()
+                status_changed = status_hash != cache['last_status_hash'] or \
+                    current_time - cache['last_status_write_time'] >= STATUS_REWRITE_INTERVAL
+                update_realtime_status(data, account_id, batch=batch, persist=status_changed)
+                if status_changed:
+                    cache['last_status_hash'] = status_hash
+                    cache['last_status_write_time'] = current_time
+                
+                # 📊 Logs and alerts for every reading, throttled as one stream
+                for sample in samples:
+                    log_esp32_sample(sample, cache, account_id, batch, current_time)
+                
+                # 💧 Update daily consumption ONLY every 30 minutes
+                if 'volume_in_L' in data:
+                    if current_time - cache['last_consumption_update_time'] >= CONSUMPTION_UPDATE_INTERVAL:
+                        update_consumption_batch(data['volume_in_L'], account_id=account_id, batch=batch, today_iso=g.today_iso)
+                        cache['last_consumption_update_time'] = current_time
+                        logger.info(f"💧 Consumption updated for {account_id} (30min interval)")
+                
+                # 📦 Committed in the background so the ESP32 isn't kept waiting on it
+                queued = enqueue_batch(batch, account_id)
+            except Exception:
+                cache.update(throttle_state)
+                raise
             
-            if should_log_power:
-                add_power_log(
-                    data['battery_voltage_V'],
-                    data['current_A'],
-                    data['battery_percent'],
-                    account_id=account_id
-                )
-                cache['last_power_log_time'] = current_time
-                cache['last_logged_values']['battery_percent'] = data['battery_percent']
-                print(f"🔋 Power logged for {account_id}: {reason}")
-        
-        # 🚨 Check for alerts (ONLY create if state changed)
-        # Leakage alert
-        if data.get('leakage_detected', False):
-            # Only alert if this is a NEW leakage
-            if not cache['last_logged_values'].get('leakage_detected', False):
-                add_alert("Leakage", "Flow differential exceeded threshold", account_id=account_id)
-        
-        cache['last_logged_values']['leakage_detected'] = data.get('leakage_detected', False)
-        
-        # Low battery alert
-        if data.get('battery_percent', 100) <= 10:
-            # Only alert once when crossing the 10% threshold
-            if cache['last_logged_values'].get('battery_percent', 100) > 10:
-                add_alert("Low Battery", f"Battery at {data.get('battery_percent')}%", account_id=account_id)
-        
-        # 💧 Update daily consumption ONLY every 30 minutes
-        if 'volume_in_L' in data:
-            if current_time - cache['last_consumption_update_time'] >= CONSUMPTION_UPDATE_INTERVAL:
-                update_consumption_batch(data['volume_in_L'], account_id=account_id)
-                cache['last_consumption_update_time'] = current_time
-                print(f"💧 Consumption updated for {account_id} (30min interval)")
-        
-        # Check if there's a pending command
+            if not queued:
+                # Shed load instead of buffering without limit. Nothing from this post was
+                # written, so the device's next post re-stages its logs, alerts and consumption
+                cache.update(throttle_state)
+        
+        if not queued:
+            return jsonify({"error": "Server busy, retry later"}), 503
+        
+        # Hand back any pending command here so the ESP32 doesn't need a separate
+        # /api/esp32/command poll. It is claimed in a transaction, so a command set
+        # after the read is never marked delivered without being sent
         cmd = get_command(account_id)
-        response = {"status": "ok"}
+        response = {"status": "ok", "command": "NONE"}
         
         if cmd and cmd.get('status') == 'pending':
-            response['command'] = cmd.get('action')
+            action = claim_pending_command(account_id)
+            if action:
+                response['command'] = action
         
         return jsonify(response)
         
     except Exception as e:
-        print(f"Error in ESP32 status update: {e}")
+        logger.error(f"Error in ESP32 status update: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/esp32/command", methods=["GET"])
 def esp32_get_command():
-    """Endpoint for ESP32 to poll for commands"""
+    """Fallback endpoint for ESP32 to poll for commands (status updates already return them)"""
     try:
         # Get account_id from query parameter
         account_id = request.args.get('account_id')
         
         if not account_id:
             return jsonify({"error": "account_id is required"}), 400
+        if not is_valid_account_id(account_id):
+            return jsonify({"error": "Invalid account_id"}), 400
         
         cmd = get_command(account_id)
         
+        # Repeat polls of an already-delivered command stay a single read; only
+        # a pending one pays for the transaction that marks it delivered
         if cmd and cmd.get('status') == 'pending':
-            # Mark as delivered
-            get_subcollection('commands', account_id).document('control').update({
-                'status': 'delivered'
-            })
-            return jsonify({"command": cmd.get('action')})
+            action = claim_pending_command(account_id)
+            if action:
+                return jsonify({"command": action})
         
         return jsonify({"command": "NONE"})
         
     except Exception as e:
-        print(f"Error getting command: {e}")
+        logger.error(f"Error getting command: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/esp32/command/ack", methods=["POST"])
@@ -1371,20 +2095,49 @@ def esp32_command_ack():
         if not account_id:
             return jsonify({"error": "account_id is required"}), 400
         
+        batch = db.batch()
+        
         # Mark command as executed
-        get_subcollection('commands', account_id).document('control').update({
+        batch.update(get_subcollection('commands', account_id).document('control'), {
             'status': 'executed'
         })
         
         # Log the control action
-        add_control_log(action, method="Remote", account_id=account_id)
+        add_control_log(action, method="Remote", account_id=account_id, batch=batch)
+        
+        batch.commit()
         
         return jsonify({"status": "acknowledged"})
         
     except Exception as e:
-        print(f"Error acknowledging command: {e}")
+        logger.error(f"Error acknowledging command: {e}")
         return jsonify({"error": str(e)}), 500
 
+def build_status_payload(status, esp32_online):
+    """Dashboard status JSON for a realtime status document (or None if missing)"""
+    status = status or {}
+    
+    # ✅ FIXED: Provide BOTH field name formats for compatibility
+    return {
+        "pump": status.get("pump_state", "N/A"),
+        "flow_in": status.get("flow_in_L_min", 0),
+        "flow_out": status.get("flow_out_L_min", 0),
+        "volume_in": status.get("volume_in_L", 0),
+        "volume_out": status.get("volume_out_L", 0),
+        "leakage": status.get("leakage_detected", False),
+        "battery_percent": status.get("battery_percent", 0),
+        
+        # ✅ FIXED: Provide both old and new field names for compatibility
+        "battery_voltage": status.get("battery_voltage_V", 0),
+        "battery_voltage_V": status.get("battery_voltage_V", 0),
+        
+        "current_consumed": status.get("current_A", 0),
+        "current_A": status.get("current_A", 0),
+        
+        "esp32_online": esp32_online,
+        "esp32_connected": esp32_online
+    }
+
 @app.route("/status-data")
 def status_data():
     """Get current status for dashboard"""
@@ -1392,50 +2145,65 @@ def status_data():
         return jsonify({"error": "Not logged in"}), 403
     
     try:
-        status = get_realtime_status()
-        if not status:
-            status = {
-                "pump_state": "N/A",
-                "flow_in_L_min": 0,
-                "flow_out_L_min": 0,
-                "battery_percent": 0,
-                "leakage_detected": False,
-                "esp32_online": False
-            }
+        consumption, status = get_dashboard_data(get_current_account_id(), g.today)
         
-        # Check if ESP32 is online
-        esp32_online = is_esp32_online()
-        
-        # ✅ FIXED: Provide BOTH field name formats for compatibility
-        data = {
-            "pump": status.get("pump_state", "N/A"),
-            "flow_in": status.get("flow_in_L_min", 0),
-            "flow_out": status.get("flow_out_L_min", 0),
-            "volume_in": status.get("volume_in_L", 0),
-            "volume_out": status.get("volume_out_L", 0),
-            "leakage": status.get("leakage_detected", False),
-            "battery_percent": status.get("battery_percent", 0),
-            
-            # ✅ FIXED: Provide both old and new field names for compatibility
-            "battery_voltage": status.get("battery_voltage_V", 0),
-            "battery_voltage_V": status.get("battery_voltage_V", 0),
-            
-            "current_consumed": status.get("current_A", 0),
-            "current_A": status.get("current_A", 0),
-            
-            "esp32_online": esp32_online,
-            "esp32_connected": esp32_online
-        }
+        data = build_status_payload(status, is_esp32_online(status))
         
         # Merge consumption summary
-        data.update(get_consumption_summary())
+        data.update(consumption)
         
         return jsonify(data)
         
     except Exception as e:
-        print(f"Error getting status: {e}")
+        logger.error(f"Error getting status: {e}")
         return jsonify({"error": str(e)}), 500
 
+# ------------------------------- 
+# 📡 Realtime Status Streaming
+# ------------------------------- 
+STREAM_HEARTBEAT = 15          # seconds between repeats when nothing changes
+STREAM_MAX_DURATION = 300      # close streams periodically; EventSource reconnects
+# Each open stream holds a worker thread (see gunicorn.conf.py), so only part of the
+# thread pool may stream; past that /stream answers 503 and the dashboard polls instead
+STREAM_MAX_CLIENTS = int(os.environ.get("STREAM_MAX_CLIENTS", 8))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
+
+@app.route("/stream")
+def stream_status():
+    """Push dashboard status to the browser as Server-Sent Events"""
+    if not require_login():
+        return jsonify({"error": "Not logged in"}), 403
+    
+    account_id = get_current_account_id()
+    
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many open streams, poll /status-data instead"}), 503
+    
+    def generate():
+        updates = subscribe_status(account_id)
+        try:
+            status = get_realtime_status(account_id)
+            deadline = time.monotonic() + STREAM_MAX_DURATION
+            while time.monotonic() < deadline:
+                data = build_status_payload(status, is_esp32_online(status))
+                data.update(get_consumption_summary(account_id))
+                yield f"data: {app.json.dumps(data)}\n\n"
+                try:
+                    status = updates.get(timeout=STREAM_HEARTBEAT)
+                except queue.Empty:
+                    # Resend the last status so the online indicator can age out
+                    pass
+        finally:
+            unsubscribe_status(account_id, updates)
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs even if the client leaves before the first event is sent
+    response.call_on_close(stream_slots.release)
+    return response
+
 @app.route("/toggle_pump", methods=["POST"])
 def toggle_pump():
     """Toggle pump state via web interface"""
@@ -1459,12 +2227,12 @@ def toggle_pump():
         # Log the action - WITH ACCOUNT ID!
         add_control_log(f"TURN_{new_state}", method="Manual", account_id=account_id)
         
-        print(f"✅ Command set for account {account_id}: {new_state}")
+        logger.info(f"✅ Command set for account {account_id}: {new_state}")
         
         return jsonify({"pump": new_state, "status": "command_sent", "account_id": account_id})
         
     except Exception as e:
-        print(f"Error toggling pump: {e}")
+        logger.error(f"Error toggling pump: {e}")
         return jsonify({"error": str(e)}), 500
 
 # ------------------------------- 
@@ -1511,7 +2279,7 @@ def get_profile():
         })
         
     except Exception as e:
-        print(f"❌ Error getting profile: {e}")
+        logger.error(f"❌ Error getting profile: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/profile", methods=["PUT"])
@@ -1535,6 +2303,8 @@ def update_profile():
                 'last_name': last_name
             })
             
+            user_cache.pop(normalize_email(session.get('user')), None)
+            
             # Update session
             session["user_name"] = f"{first_name} {last_name}"
         
@@ -1551,11 +2321,11 @@ def update_profile():
         if update_data:
             db.collection('accounts').document(account_id).update(update_data)
         
-        print(f"✅ Profile updated for user {user_id}")
+        logger.info(f"✅ Profile updated for user {user_id}")
         return jsonify({"success": True, "message": "Profile updated successfully"})
         
     except Exception as e:
-        print(f"❌ Error updating profile: {e}")
+        logger.error(f"❌ Error updating profile: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/profile/email", methods=["PUT"])
@@ -1582,26 +2352,34 @@ def update_email():
         
         user = user_doc.to_dict()
         
-        if user.get('password_hash') != password:
+        if not verify_password(user, password):
             return jsonify({"error": "Incorrect password"}), 403
         
-        # Check if email already exists
-        existing = db.collection('users').where('email', '==', new_email).limit(1).get()
-        for doc in existing:
-            if doc.id != user_id:
-                return jsonify({"error": "Email already in use"}), 400
+        new_email = normalize_email(new_email)
         
-        # Update email
-        db.collection('users').document(user_id).update({'email': new_email})
+        # Check if email already exists: the email index first, then the same legacy
+        # query fallback registration uses (given the address as typed)
+        existing = get_user_by_email(data.get('email'))
+        if existing and existing['doc_id'] != user_id:
+            return jsonify({"error": "Email already in use"}), 400
+        
+        # Update email and move its index pointer along with it
+        batch = db.batch()
+        batch.update(db.collection('users').document(user_id), {'email': new_email})
+        if new_email != normalize_email(user.get('email')):
+            batch.delete(get_email_index_ref(user.get('email')))
+        batch.set(get_email_index_ref(new_email), {'user_id': user_id})
+        batch.commit()
+        user_cache.pop(normalize_email(user.get('email')), None)
         
         # Update session
         session["user"] = new_email
         
-        print(f"✅ Email updated for user {user_id}")
+        logger.info(f"✅ Email updated for user {user_id}")
         return jsonify({"success": True, "message": "Email updated successfully"})
         
     except Exception as e:
-        print(f"❌ Error updating email: {e}")
+        logger.error(f"❌ Error updating email: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/profile/password", methods=["PUT"])
@@ -1631,17 +2409,18 @@ def update_password():
         
         user = user_doc.to_dict()
         
-        if user.get('password_hash') != current_password:
+        if not verify_password(user, current_password):
             return jsonify({"error": "Incorrect current password"}), 403
         
         # Update password
-        db.collection('users').document(user_id).update({'password_hash': new_password})
+        db.collection('users').document(user_id).update({'password_hash': hash_password(new_password)})
+        user_cache.pop(normalize_email(user.get('email')), None)
         
-        print(f"✅ Password updated for user {user_id}")
+        logger.info(f"✅ Password updated for user {user_id}")
         return jsonify({"success": True, "message": "Password updated successfully"})
         
     except Exception as e:
-        print(f"❌ Error updating password: {e}")
+        logger.error(f"❌ Error updating password: {e}")
         return jsonify({"error": str(e)}), 500
 
 # ------------------------------- 
@@ -1655,7 +2434,18 @@ def login():
         
         user = get_user_by_email(email)
         
-        if user and user.get("password_hash") == password:
+        if verify_password(user, password):
+            # Upgrade legacy plain-text passwords now that we know the password
+            if is_legacy_password(user.get("password_hash") or ""):
+                try:
+                    db.collection('users').document(user['doc_id']).update({
+                        'password_hash': hash_password(password)
+                    })
+                    user_cache.pop(normalize_email(email), None)
+                    logger.info(f"🔐 Password hash upgraded for {email}")
+                except Exception as e:
+                    logger.error(f"Error upgrading password hash: {e}")
+            
             # ✅ Store account_id in session
             session["user"] = email
             session["user_name"] = f"{user['first_name']} {user['last_name']}"
@@ -1670,9 +2460,9 @@ def login():
                     account_data = account_doc.to_dict()
                     session["admin_number"] = account_data.get("admin_number", "+639850326985")
                     session["device_name"] = account_data.get("device_name", "AquaSolar")
-                    print(f"✅ User {email} logged in with account {user.get('account_id_fk')}")
+                    logger.info(f"✅ User {email} logged in with account {user.get('account_id_fk')}")
             except Exception as e:
-                print(f"Error loading account details: {e}")
+                logger.error(f"Error loading account details: {e}")
             
             return redirect(url_for("index"))
         
@@ -1685,11 +2475,11 @@ def register():
     if request.method == 'POST':
         first_name = request.form['firstname']
         last_name = request.form['lastname']
-        email = request.form['email']
+        email = normalize_email(request.form['email'])
         password = request.form['password']
         owner_code = request.form['owner_code']
         
-        if owner_code != SECRET_TOKEN:
+        if not hmac.compare_digest(owner_code.encode(), SECRET_TOKEN.encode()):
             return render_template("register.html", error="Invalid owner code!")
         
         # Check if user exists
@@ -1699,10 +2489,15 @@ def register():
         # ✅ Create unique account for this user
         try:
             # Generate unique IDs
-            user_id = f"USER_{uuid.uuid4().hex[:8].upper()}"
-            account_id = f"ACC_{uuid.uuid4().hex[:8].upper()}"  # UNIQUE for each user!
+            user_id = f"USER_{secrets.token_hex(4).upper()}"
+            account_id = f"ACC_{secrets.token_hex(4).upper()}"  # UNIQUE for each user!
+            
+            logger.info(f"🆕 Creating new user: {email} with account {account_id}")
             
-            print(f"🆕 Creating new user: {email} with account {account_id}")
+            # Everything below is committed as one batch: a single round trip, and a
+            # failed signup never leaves a half-provisioned account behind
+            batch = db.batch()
+            account_ref = db.collection('accounts').document(account_id)
             
             # Create account first
             account_data = {
@@ -1712,11 +2507,10 @@ def register():
                 "device_name": f"AquaSolar - {first_name}",
                 "admin_number": "+639850326985"  # Default, user can change later
             }
-            db.collection('accounts').document(account_id).set(account_data)
-            print(f"✅ Account {account_id} created")
+            batch.set(account_ref, account_data)
             
             # Initialize realtime_status for new account
-            db.collection('accounts').document(account_id).collection('realtime_status').document('current').set({
+            batch.set(account_ref.collection('realtime_status').document('current'), {
                 "flow_in_L_min": 0.0,
                 "flow_out_L_min": 0.0,
                 "volume_in_L": 0.0,
@@ -1728,15 +2522,13 @@ def register():
                 "leakage_detected": False,
                 "last_update": firestore.SERVER_TIMESTAMP
             })
-            print(f"✅ Realtime status initialized for {account_id}")
             
             # Initialize commands document
-            db.collection('accounts').document(account_id).collection('commands').document('control').set({
+            batch.set(account_ref.collection('commands').document('control'), {
                 "action": "NONE",
                 "timestamp": firestore.SERVER_TIMESTAMP,
                 "status": "executed"
             })
-            print(f"✅ Commands initialized for {account_id}")
             
             # Create user with link to new account
             user_data = {
@@ -1744,17 +2536,20 @@ def register():
                 "first_name": first_name,
                 "last_name": last_name,
                 "email": email,
-                "password_hash": password,  # ⚠️ Use bcrypt in production!
+                "password_hash": hash_password(password),
                 "account_id_fk": account_id,  # Link to unique account
                 "created_at": datetime.now().isoformat()  # Store registration date
             }
-            db.collection('users').document(user_id).set(user_data)
-            print(f"✅ User {user_id} created and linked to account {account_id}")
+            batch.set(db.collection('users').document(user_id), user_data)
+            # create() fails the whole batch if the email was claimed in the meantime
+            batch.create(get_email_index_ref(email), {'user_id': user_id})
+            batch.commit()
+            logger.info(f"✅ User {user_id} created and linked to new account {account_id}")
             
             return redirect(url_for('login'))
             
         except Exception as e:
-            print(f"❌ Error creating user: {e}")
+            logger.error(f"❌ Error creating user: {e}")
             return render_template("register.html", error="Registration failed. Please try again.")
     
     return render_template("register.html", error=None)
@@ -1774,6 +2569,8 @@ def health():
         "status": "healthy", 
         "firebase": "connected" if db else "disconnected",
         "optimization": "enabled",
+        "write_queue_depth": sum(worker_queue.qsize() for worker_queue in write_queues),
+        "dropped_writes": dropped_writes,
         "multi_user": "enabled"
     })
 
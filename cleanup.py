@@ -1,6 +1,7 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIGURATION: Replace with your actual service account key file ---
 SERVICE_ACCOUNT_KEY_PATH = 'aqua-7ced9-firebase-adminsdk-fbsvc-d94e9eb953.json'
@@ -17,37 +18,34 @@ except Exception as e:
     print("Please ensure your service account key file path is correct.")
     exit()
 
-def delete_collection(collection_name, batch_size=100):
-    """Delete all documents in a collection"""
-    collection_ref = db.collection(collection_name)
-    docs = collection_ref.limit(batch_size).stream()
+def delete_query(query, label, batch_size):
+    """Delete every document a query returns, one WriteBatch commit per page"""
     deleted = 0
     
-    for doc in docs:
-        print(f"   Deleting {collection_name}/{doc.id}")
-        doc.reference.delete()
-        deleted += 1
-    
-    if deleted >= batch_size:
-        return delete_collection(collection_name, batch_size)
-    
-    return deleted
+    while True:
+        docs = list(query.limit(batch_size).stream())
+        if not docs:
+            return deleted
+        
+        batch = db.batch()
+        for doc in docs:
+            print(f"{label}/{doc.id}")
+            batch.delete(doc.reference)
+        batch.commit()
+        deleted += len(docs)
+        
+        if len(docs) < batch_size:
+            return deleted
 
-def delete_subcollection(account_id, subcollection_name, batch_size=100):
-    """Delete all documents in a subcollection"""
+def delete_collection(collection_name, batch_size=500):
+    """Delete all documents in a collection (a WriteBatch holds at most 500 writes)"""
+    collection_ref = db.collection(collection_name)
+    return delete_query(collection_ref, f"   Deleting {collection_name}", batch_size)
+
+def delete_subcollection(account_id, subcollection_name, batch_size=500):
+    """Delete all documents in a subcollection (a WriteBatch holds at most 500 writes)"""
     subcol_ref = db.collection('accounts').document(account_id).collection(subcollection_name)
-    docs = subcol_ref.limit(batch_size).stream()
-    deleted = 0
-    
-    for doc in docs:
-        print(f"      Deleting {subcollection_name}/{doc.id}")
-        doc.reference.delete()
-        deleted += 1
-    
-    if deleted >= batch_size:
-        return delete_subcollection(account_id, subcollection_name, batch_size)
-    
-    return deleted
+    return delete_query(subcol_ref, f"      Deleting {subcollection_name}", batch_size)
 
 def cleanup_all_data():
     """Delete ALL data from Firebase Firestore"""
@@ -101,22 +99,25 @@ def cleanup_all_data():
         'control_logs',
         'power_logs',
         'alerts',
-        'consumption'
+        'consumption',
+        'aggregates'
     ]
     
-    for account_id in account_ids:
-        print(f"\n📁 Processing account: {account_id}")
-        for subcol in subcollections:
-            count = delete_subcollection(account_id, subcol)
+    # Deletes spend their time waiting on Firestore, so clear many subcollections at once;
+    # results are reported in account order as they complete
+    pairs = [(account_id, subcol) for account_id in account_ids for subcol in subcollections]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        counts = executor.map(lambda pair: delete_subcollection(*pair), pairs)
+        for (account_id, subcol), count in zip(pairs, counts):
             if count > 0:
-                print(f"   ✅ Deleted {count} documents from {subcol}")
+                print(f"   ✅ Deleted {count} documents from {account_id}/{subcol}")
     
     # Step 2: Delete top-level collections
     print("\n" + "=" * 70)
     print("STEP 2: Deleting Top-Level Collections")
     print("=" * 70)
     
-    collections_to_delete = ['users', 'accounts', 'sensors']
+    collections_to_delete = ['users', 'email_index', 'accounts', 'sensors']
     
     for collection_name in collections_to_delete:
         print(f"\n🗑️  Deleting collection: {collection_name}")
@@ -84,6 +84,7 @@ subcollection_names = [
     "power_logs",
     "alerts",
     "consumption",
+    "aggregates",
     "realtime_status",
     "commands"
 ]
@@ -95,7 +96,7 @@ for account_id in account_ids:
 # Step 3: Delete top-level collections
 print("\n--- Deleting top-level collections ---")
 
-top_level_collections = ["users", "accounts", "sensors"]
+top_level_collections = ["users", "email_index", "accounts", "sensors"]
 
 for collection_name in top_level_collections:
     collection_ref = db.collection(collection_name)
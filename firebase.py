@@ -2,6 +2,7 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 from datetime import datetime, date
 import uuid
+import hashlib
 
 # --- CONFIGURATION: Replace with your actual service account key file ---
 SERVICE_ACCOUNT_KEY_PATH = 'aqua-1-c55af-firebase-adminsdk-fbsvc-7984537d62.json'
@@ -81,6 +82,8 @@ def create_user_and_account(user_config):
         "account_id_fk": account_id
     }
     db.collection('users').document(user_id).set(user_data)
+    email_key = hashlib.sha256(user_config["email"].strip().lower().encode()).hexdigest()
+    db.collection('email_index').document(email_key).set({"user_id": user_id})
     print(f"✅ User created: {user_config['email']}")
     
     # 2. Create Account Document
@@ -246,6 +249,9 @@ def cleanup_existing_data():
         user_count += 1
     print(f"✅ Deleted {user_count} users")
     
+    for index_doc in db.collection('email_index').stream():
+        index_doc.reference.delete()
+    
     print("🗑️  Deleting existing accounts...")
     accounts = db.collection('accounts').stream()
     account_count = 0
@@ -255,7 +261,8 @@ def cleanup_existing_data():
         
         # Delete subcollections
         subcollections = ['realtime_status', 'commands', 'sensor_logs', 
-                         'control_logs', 'power_logs', 'alerts', 'consumption']
+                         'control_logs', 'power_logs', 'alerts', 'consumption',
+                         'aggregates']
         
         for subcol in subcollections:
             docs = db.collection('accounts').document(account_id).collection(subcol).stream()
@@ -0,0 +1,29 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app`
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Requests spend nearly all their time waiting on Firestore, so serve them
+# from threads: one worker keeps many ESP32/dashboard requests in flight.
+# A single worker also keeps the in-process throttling caches consistent.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# Thread budget: every open dashboard /stream (Server-Sent Events) occupies one of
+# these threads for up to 5 minutes. The app lets at most STREAM_MAX_CLIENTS
+# (default 8) stream per worker and sends the rest to polling, so the other threads
+# always stay free for ESP32 posts and logins. Raise both together.
+
+# ESP32s post every few seconds; holding the connection open between posts
+# spares each one a fresh TCP (and TLS) handshake. gthread workers park idle
+# keep-alive sockets without tying up a thread.
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 30))
+worker_connections = 1000
+
+# Load the app in each worker after the fork, never in the master: the Firestore
+# gRPC channel and the write-queue threads are opened at import time and do not
+# survive a fork, so every worker must build (and warm) its own.
+preload_app = False
+
+timeout = 60
@@ -0,0 +1,63 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+import hashlib
+
+# --- CONFIGURATION: Replace with your actual service account key file ---
+SERVICE_ACCOUNT_KEY_PATH = 'aqua-7ced9-firebase-adminsdk-fbsvc-d94e9eb953.json'
+# --- END CONFIGURATION ---
+
+try:
+    # Initialize Firebase Admin
+    cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+    print("✅ Firebase initialized.")
+except Exception as e:
+    print(f"❌ Error initializing Firebase: {e}")
+    print("Please ensure your service account key file path is correct.")
+    exit()
+
+def email_index_key(email):
+    """Same key the app uses: sha256 of the lowercased email"""
+    return hashlib.sha256(email.strip().lower().encode()).hexdigest()
+
+def backfill_email_index():
+    """Write an email_index pointer for every existing user (safe to re-run)"""
+    print("\n" + "=" * 70)
+    print("📇 Backfilling email_index")
+    print("=" * 70)
+    
+    batch = db.batch()
+    pending = 0
+    written = 0
+    skipped = 0
+    
+    for user in db.collection('users').stream():
+        email = user.to_dict().get('email')
+        if not email:
+            print(f"   ⚠️  Skipping {user.id}: no email")
+            skipped += 1
+            continue
+        
+        batch.set(db.collection('email_index').document(email_index_key(email)), {'user_id': user.id})
+        pending += 1
+        written += 1
+        
+        # A WriteBatch holds at most 500 writes
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    
+    if pending:
+        batch.commit()
+    
+    print(f"\n✅ Indexed {written} users ({skipped} skipped)")
+    return written
+
+# =========================================================================
+# SCRIPT EXECUTION
+# =========================================================================
+
+if __name__ == "__main__":
+    backfill_email_index()